@@ -19,7 +19,7 @@ H = frame.shape[0]
 print('width = {:d}, height = {:d}'.format(W,H))
 
 # process the frames
-while  frame != []  :
+while len(frame):
     print('processing frame {:d}'.format(idx))
     detections = []
 
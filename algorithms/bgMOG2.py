@@ -120,18 +120,14 @@ def bgMOG2():
 
     if args.verbose: print('initializting background...')
     n = min(10, api.nframes())
-    hist = np.zeros((width*height,n),dtype=np.uint8)
-
-    for i in range(n):
-        if args.verbose: print(i)
-        # convert to grayscale, if frame is color image
-        if depth > 1: 
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        hist[:,i] = frame.flatten()
-        frame, idx = api.get_frame()
+    api.rewind()
+    hist, idxs = api.get_frames(n)
+    # frames are gray levels, in 3 channels if the input is in color
+    if depth > 1:
+        hist = hist[..., 0]
 
-    bg_init = np.mean(hist,axis=1,dtype=np.float64).reshape(width,height).astype(np.uint8)
-    #bg_std = np.std(hist,axis=1,dtype=np.float64)
+    bg_init = np.mean(hist,axis=0,dtype=np.float64).astype(np.uint8)
+    #bg_std = np.std(hist,axis=0,dtype=np.float64)
 
     if args.verbose: 
         print('mean image')
@@ -158,7 +154,7 @@ def bgMOG2():
     api.rewind()
     frame, idx = api.get_frame()
 
-    while(frame != []):
+    while len(frame):
         # convert to grayscale, if frame is color image
         if depth > 1: 
             frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
@@ -199,7 +195,8 @@ def bgMOG2():
         if args.xml: api.put_results_xml(idx, detections)
         frame, idx = api.get_frame()
  
-    cv2.destroyAllWindows()
+    # windows are only shown with --verbose
+    if args.verbose: cv2.destroyAllWindows()
     if args.verbose: print("processed {:d} frames".format(idx)) 
   
     # save the results 
@@ -6,8 +6,12 @@ import os       # path name manipulations
 import glob     # filename pattern matching
 import json
 import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2 # openCV for image processing
+import numpy as np
 
 # XML for working with VOC format annotations
 from lxml import etree as ET
@@ -31,6 +35,7 @@ if input is a movie, then extract the frames
 -need space for image data
 -no direct support for live camera
 -have to make into movie for eyesea app (current implementation)
+-uploaded movies have to be extracted before they can be analyzed
 
 Option 3
 always use a Stream
@@ -39,7 +44,8 @@ if input is image dir, then make into movie with copy vcodec
 -need space for movie file
 -can't play copy vcodec in eyesea app (web requires mp4)
 '''
-# going with Option 2 
+# going with Option 2, except that a movie file is read directly with a
+# VideoCapture instead of being extracted (see open_video())
 
 # GLOBAL VARS
 # input directory that contains image files
@@ -51,17 +57,35 @@ eyesea_api_output = []
 
 # list of image files in input directory
 eyesea_api_infiles = []
-# shape of each image file, used in annotation file
-# assume all images have the same shape
-eyesea_api_shapes = []
+# (height, width, depth) of each frame, used in annotation file;
+# an (nframes, 3) array filled in by get_frame()
+eyesea_api_shapes = None
 # total number of images (frames)
 eyesea_api_nframes = 0
 # index of next image file (frame) to process
 eyesea_api_nextf = 0
-# results, see put_results()
-eyesea_api_results = []
+# frames [eyesea_api_start, eyesea_api_end) are processed, the ones from
+# eyesea_api_first on are read to warm up the algorithm, see frame_range()
+eyesea_api_first = 0
+eyesea_api_start = 0
+eyesea_api_end = 0
+# results, a detection_store, see put_results()
+eyesea_api_results = None
 # algorithm name
 eyesea_api_alg = []
+# read-ahead of get_frame(), see prefetch()
+eyesea_api_prefetch = 0
+eyesea_api_pool = None
+# futures of the frames after eyesea_api_nextf, in order
+eyesea_api_pending = deque()
+# VideoCapture of a movie file input, None for a directory of images
+eyesea_api_capture = None
+# index of the frame the capture reads next
+eyesea_api_position = 0
+# decode buffer of the capture, reused by every read
+eyesea_api_buffer = None
+# frames returned by get_frames(), reused by every call
+eyesea_api_batch = None
 
 # parse command line arguments based on json file definitions
 def get_args(jfile):
@@ -88,32 +112,51 @@ def get_args(jfile):
 
     parser.add_argument('--verbose', '-v', action='store_true')
     parser.add_argument('--xml', '-x', help="output VOC xml", action='store_true')
+    parser.add_argument('--prefetch', type=int, default=8,
+                        help="frames read ahead by get_frame(), 0 to read each frame when it is asked for")
+    parser.add_argument('--prefetch-threads', type=int, default=2, help="threads reading ahead")
+    parser.add_argument('--start', type=int, default=0, help="first frame to process")
+    parser.add_argument('--end', type=int, default=None, help="frame after the last one to process, default the last frame")
+    parser.add_argument('--warmup', type=int, default=0,
+                        help="frames before --start read to warm up the algorithm, their results are not saved")
     args = parser.parse_args()
     global eyesea_api_indir
     global eyesea_api_infiles
     global eyesea_api_nframes
     global eyesea_api_output
     global eyesea_api_results
+    global eyesea_api_shapes
     eyesea_api_indir = args.input
 
-    if args.verbose: print('processing input dir: ' + eyesea_api_indir)
+    if os.path.isdir(eyesea_api_indir):
+        if args.verbose: print('processing input dir: ' + eyesea_api_indir)
 
-    # try jpg first
-    eyesea_api_infiles = sorted(glob.glob(os.path.join(eyesea_api_indir,'*.jpg')))
-    if not eyesea_api_infiles:
-        # try png
-        eyesea_api_infiles = sorted(glob.glob(os.path.join(eyesea_api_indir,'*.png')))
-    eyesea_api_nframes = len(eyesea_api_infiles)
+        # try jpg first
+        eyesea_api_infiles = sorted(glob.glob(os.path.join(eyesea_api_indir,'*.jpg')))
+        if not eyesea_api_infiles:
+            # try png
+            eyesea_api_infiles = sorted(glob.glob(os.path.join(eyesea_api_indir,'*.png')))
+        eyesea_api_nframes = len(eyesea_api_infiles)
+    else:
+        if args.verbose: print('processing input video: ' + eyesea_api_indir)
+        open_video(eyesea_api_indir)
 
     
     if args.verbose: print('found {:d} frames'.format(eyesea_api_nframes))
 
-    eyesea_api_results = [None] * eyesea_api_nframes
+    eyesea_api_results = detection_store(eyesea_api_nframes)
+    eyesea_api_shapes = np.zeros((eyesea_api_nframes, 3), np.int32)
 
     eyesea_api_output = args.output
 
     if args.verbose: print('saving results to ' + eyesea_api_output)
 
+    frame_range(args.start, args.end, args.warmup)
+    if args.verbose and (args.start or args.end is not None):
+        print('processing frames {:d} to {:d} after {:d} warm-up frames'.format(
+            eyesea_api_start, eyesea_api_end, eyesea_api_start - eyesea_api_first))
+    prefetch(args.prefetch, args.prefetch_threads)
+
     # check if dir or file
     # if no extension, assume its a dir
     if not os.path.splitext(eyesea_api_output)[1]:
@@ -132,15 +175,147 @@ def nframes():
     global eyesea_api_nframes
     return eyesea_api_nframes
 
+# Process frames [start, end) of the input only, so that one input can be
+# split between processes.  get_frame() starts warmup frames before start,
+# letting a model with state (like a background) converge first; results of
+# the warm-up frames are not saved.  end None is the end of the input.
+# Called by get_args() with --start, --end and --warmup.
+def frame_range(start=0, end=None, warmup=0):
+    global eyesea_api_first
+    global eyesea_api_start
+    global eyesea_api_end
+    global eyesea_api_nextf
+    _drop_pending()
+    eyesea_api_start = min(max(0, int(start)), eyesea_api_nframes)
+    eyesea_api_end = eyesea_api_nframes if end is None else min(max(eyesea_api_start, int(end)), eyesea_api_nframes)
+    eyesea_api_first = max(0, eyesea_api_start - max(0, int(warmup)))
+    eyesea_api_nextf = eyesea_api_first
+
 def indir():
     global eyesea_api_indir
     return eyesea_api_indir
 
+# path of the image file of a frame; for a video input, the video path
+# without its extension followed by the frame index, which is used to name
+# the VOC annotation of the frame
 def framefilepath(idx):
     global eyesea_api_infiles
+    if eyesea_api_capture is not None:
+        return '{}_{:06d}'.format(os.path.splitext(eyesea_api_indir)[0], idx)
     return eyesea_api_infiles[idx]    
 
-clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+# Number of frames of a capture.  The count of the container is used if the
+# frame before it can be read and the one at it can't; when it is missing or
+# wrong the frames are counted by grabbing them all.  Leaves the capture at
+# an unknown position.
+def count_frames(capture):
+    n = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    if n > 0:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, n - 1)
+        if capture.grab() and not capture.grab():
+            return n
+    capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    n = 0
+    while capture.grab():
+        n += 1
+    return n
+
+# Read the frames of a movie file (mp4, avi, anything OpenCV can decode)
+# instead of a directory of images.  Called by get_args() when the input is
+# not a directory.  The number of frames is checked with count_frames(); if
+# the video still ends early, nframes() is reduced when get_frame() reaches
+# its end.
+def open_video(path):
+    global eyesea_api_capture
+    global eyesea_api_position
+    global eyesea_api_nframes
+    global eyesea_api_infiles
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError('unable to open video ' + path)
+    eyesea_api_capture = capture
+    eyesea_api_infiles = []
+    eyesea_api_nframes = count_frames(capture)
+    # the first read seeks back to the start
+    eyesea_api_position = -1
+
+# CLAHE objects are not shared between threads
+eyesea_api_local = threading.local()
+
+def _clahe():
+    if not hasattr(eyesea_api_local, 'clahe'):
+        eyesea_api_local.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    return eyesea_api_local.clahe
+
+# equalize the contrast of a frame (CLAHE on the gray levels), color images
+# are returned as gray levels in 3 channels.  Always returns a new array.
+def equalize(img):
+    channels = img.shape[-1] if len(img.shape)==3 else 1
+    if channels > 1:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    img = _clahe().apply(img)
+
+    if channels > 1:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    return img
+
+# read an image file and equalize its contrast
+def load_frame(imfile):
+    return equalize(cv2.imread(imfile,-1))
+
+# decode frame idx of the video and equalize its contrast, None after the
+# last frame.  Frames are decoded in sequence into one buffer, so the
+# capture only seeks when idx is not the frame after the previous one (at a
+# rewind).  Only one thread may read at a time.
+def read_video_frame(idx):
+    global eyesea_api_position
+    global eyesea_api_buffer
+    if idx != eyesea_api_position:
+        eyesea_api_capture.set(cv2.CAP_PROP_POS_FRAMES, idx)
+    ok, img = eyesea_api_capture.read(eyesea_api_buffer)
+    if not ok:
+        eyesea_api_position = -1
+        return None
+    eyesea_api_buffer = img
+    eyesea_api_position = idx + 1
+    return equalize(img)
+
+def _load(idx):
+    if eyesea_api_capture is not None:
+        return read_video_frame(idx)
+    return load_frame(eyesea_api_infiles[idx])
+
+# Read up to n frames ahead of get_frame() with a pool of threads, so the
+# next frames are decoded while the algorithm works on the current one
+# (OpenCV releases the GIL).  Frames are still returned in order.  n = 0
+# reads every frame when it is asked for.  Called by get_args() with
+# --prefetch and --prefetch-threads.  A video is decoded in sequence, so it
+# is read ahead by a single thread whatever threads is.
+def prefetch(n, threads=2):
+    global eyesea_api_prefetch
+    global eyesea_api_pool
+    _drop_pending()
+    if eyesea_api_pool is not None:
+        # a video read still running must end before the next one starts
+        eyesea_api_pool.shutdown(wait=True)
+        eyesea_api_pool = None
+    eyesea_api_prefetch = max(0, int(n))
+    if eyesea_api_prefetch:
+        if eyesea_api_capture is not None:
+            threads = 1
+        eyesea_api_pool = ThreadPoolExecutor(max(1, int(threads)))
+
+def _drop_pending():
+    while eyesea_api_pending:
+        eyesea_api_pending.popleft().cancel()
+
+# keep eyesea_api_prefetch frames after eyesea_api_nextf submitted
+def _fill():
+    n = eyesea_api_nextf + len(eyesea_api_pending)
+    while len(eyesea_api_pending) < eyesea_api_prefetch and n < eyesea_api_end:
+        eyesea_api_pending.append(eyesea_api_pool.submit(_load, n))
+        n += 1
 
 # return next image as numpy array
 # if no more images, returns empty array
@@ -149,62 +324,153 @@ def get_frame():
     global eyesea_api_infiles
     global eyesea_api_nframes
     global eyesea_api_shapes
+    global eyesea_api_results
+    global eyesea_api_end
 
     img = []
     idx = eyesea_api_nextf
 
-    if eyesea_api_nextf < eyesea_api_nframes:
-        imfile = eyesea_api_infiles[eyesea_api_nextf]
-        img = cv2.imread(imfile,-1)
-        channels = img.shape[-1] if len(img.shape)==3 else 1
-        if channels > 1:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        img = clahe.apply(img)
-
-        if channels > 1:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if eyesea_api_nextf < eyesea_api_end:
+        if eyesea_api_prefetch:
+            _fill()
+            img = eyesea_api_pending.popleft().result()
+        else:
+            img = _load(eyesea_api_nextf)
+        if img is None:
+            # the video has fewer frames than its container says
+            _drop_pending()
+            eyesea_api_nframes = eyesea_api_nextf
+            eyesea_api_end = eyesea_api_nframes
+            eyesea_api_results.truncate(eyesea_api_nframes)
+            eyesea_api_shapes = eyesea_api_shapes[:eyesea_api_nframes]
+            return [], idx
         # store size for later
-        eyesea_api_shapes.append(img.shape) 
+        eyesea_api_shapes[idx] = img.shape[:2] + (img.shape[2] if img.ndim > 2 else 1,)
         eyesea_api_nextf += 1
+        if eyesea_api_prefetch:
+            _fill()
     return img, idx
 
-# reset the frame index back to 0
+# reset the frame index back to the first frame (0 unless frame_range() was
+# used), a video seeks back when the next frame is read
 def rewind():
     global eyesea_api_nextf 
-    eyesea_api_nextf = 0
+    _drop_pending()
+    eyesea_api_nextf = eyesea_api_first
+
+# Return the next n frames as one contiguous (k, H, W[, C]) array and the
+# array of their indices; k is n except at the end, 0 when there are no more
+# frames.  All the frames of a batch must have the same shape.  The array is
+# a view of a buffer that the next call overwrites, copy it to keep it.
+def get_frames(n):
+    global eyesea_api_batch
+    first = eyesea_api_nextf
+    k = 0
+    while k < n:
+        img, idx = get_frame()
+        if not len(img):
+            break
+        batch = eyesea_api_batch
+        if batch is None or batch.shape[0] < n or batch.shape[1:] != img.shape or batch.dtype != img.dtype:
+            if k:
+                raise ValueError('frame {:d} has shape {}, the batch has {}'.format(idx, img.shape, batch.shape[1:]))
+            batch = eyesea_api_batch = np.empty((n,) + img.shape, img.dtype)
+        batch[k] = img
+        k += 1
+    if not k:
+        return np.empty((0,), np.uint8), np.arange(0)
+    return eyesea_api_batch[:k], np.arange(first, first + k)
+
+# the remaining frames in batches of n, see get_frames()
+def iter_batches(n):
+    frames, idx = get_frames(n)
+    while len(idx):
+        yield frames, idx
+        frames, idx = get_frames(n)
 
 
 # class for storing bounding box
 class bbox():
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
+
     def __init__(self, x1, y1, x2, y2):
         self.x1 = x1
         self.y1 = y1
         self.x2 = x2
         self.y2 = y2
 
+# The detections of all the frames: boxes is an (n, 4) int32 array of x1, y1,
+# x2, y2 that grows by doubling, offsets and counts give the rows of each
+# frame.  Putting the detections of a frame again appends them and leaves
+# the old rows unused.
+class detection_store():
+    def __init__(self, nframes, capacity=1024):
+        self.boxes = np.empty((capacity, 4), np.int32)
+        self.size = 0
+        self.offsets = np.zeros(nframes, np.int64)
+        self.counts = np.zeros(nframes, np.int32)
+
+    # boxes is an (m, 4) array
+    def put(self, idx, boxes):
+        m = len(boxes)
+        if self.size + m > len(self.boxes):
+            grown = np.empty((max(2 * len(self.boxes), self.size + m), 4), np.int32)
+            grown[:self.size] = self.boxes[:self.size]
+            self.boxes = grown
+        self.boxes[self.size:self.size + m] = boxes
+        self.offsets[idx] = self.size
+        self.counts[idx] = m
+        self.size += m
+
+    # (m, 4) view of the boxes of frame idx
+    def get(self, idx):
+        offset = self.offsets[idx]
+        return self.boxes[offset:offset + self.counts[idx]]
+
+    def truncate(self, nframes):
+        self.offsets = self.offsets[:nframes]
+        self.counts = self.counts[:nframes]
+
+# (m, 4) array of detections, a list of bbox objects or an array; float
+# coordinates are rounded like the server rounds them, not truncated
+def _box_array(detections):
+    if not isinstance(detections, np.ndarray):
+        detections = np.array([(d.x1, d.y1, d.x2, d.y2) for d in detections or []])
+    if detections.dtype.kind == 'f':
+        detections = np.rint(detections)
+    return detections.reshape(-1, 4)
+
+# detections is a list of bbox objects or an (m, 4) array of x1, y1, x2, y2
 def put_results(idx, detections):
     global eyesea_api_results
-    eyesea_api_results[idx] = detections
+    eyesea_api_results.put(idx, _box_array(detections))
+
+# put_results() for a batch of frames: detections[i] are the detections of
+# frame indices[i]
+def put_results_batch(indices, detections):
+    global eyesea_api_results
+    for idx, boxes in zip(indices, detections):
+        eyesea_api_results.put(int(idx), _box_array(boxes))
 
 # Save the annotations in VOC XML format
 # idx is the index of the frame returned by get_frame()
 # detections is a list of bbox objects.
 def put_results_xml(idx, detections):
     global eyesea_api_infiles
+    if idx < eyesea_api_start:
+        # warm-up frame
+        return
     annotation = ET.Element("annotation")
     ET.SubElement(annotation, "folder").text = os.path.split(eyesea_api_indir)[1]
-    ET.SubElement(annotation, "filename").text = os.path.basename(eyesea_api_infiles[idx])
-    ET.SubElement(annotation, "path").text = os.path.abspath(eyesea_api_infiles[idx])    
+    ET.SubElement(annotation, "filename").text = os.path.basename(framefilepath(idx))
+    ET.SubElement(annotation, "path").text = os.path.abspath(framefilepath(idx))    
     source = ET.SubElement(annotation, "source")
     ET.SubElement(source, "database").text = 'Unknown'
     size = ET.SubElement(annotation, "size")
-    ET.SubElement(size, "width").text = str(eyesea_api_shapes[idx][1])
-    ET.SubElement(size, "height").text = str(eyesea_api_shapes[idx][0])
-    if len(eyesea_api_shapes[idx]) > 2:
-        ET.SubElement(size, "depth").text = str(eyesea_api_shapes[idx][2])
-    else:
-        ET.SubElement(size, "depth").text = "1"
+    height, width, depth = eyesea_api_shapes[idx]
+    ET.SubElement(size, "width").text = str(width)
+    ET.SubElement(size, "height").text = str(height)
+    ET.SubElement(size, "depth").text = str(depth)
     ET.SubElement(annotation, "segmented").text =str(0)
     for i in range(len(detections)):
         myobject = ET.SubElement(annotation, "object",name="detection"+str(i))
@@ -218,13 +484,24 @@ def put_results_xml(idx, detections):
         ET.SubElement(bndbox, "xmax").text = str(max(detections[i].x1, detections[i].x2))
         ET.SubElement(bndbox, "ymax").text = str(max(detections[i].y1, detections[i].y2))
     tree = ET.ElementTree(annotation)
-    outfile = os.path.splitext(os.path.basename(eyesea_api_infiles[idx]))[0] + '.xml'
+    outfile = os.path.splitext(os.path.basename(framefilepath(idx)))[0] + '.xml'
     global eyesea_api_output
     tree.write(os.path.join(eyesea_api_output,outfile), pretty_print=True)
 
                  
+# one frame of the results file, boxes is a list of [x1, y1, x2, y2]
+def _frame_json(idx, boxes):
+    return '{{"frameindex": {}, "detections": [{}]}}'.format(idx, ', '.join(
+        '{{"x1": {}, "y1": {}, "x2": {}, "y2": {}}}'.format(*b) for b in boxes))
+
 #This writes the results to a custom json file used by eyesea_server.
-def save_results():
+# By default the file is sparse: "frames" only has the frames with
+# detections and "nframes" is the number of frames processed.  With
+# sparse=False every frame is listed, as older versions did.  The file is
+# built in memory and written at once.  With frame_range(), only frames
+# from start are saved, "nframes" is the end of the range and "start" its
+# start, so the files of consecutive ranges can be joined.
+def save_results(sparse=True):
     global eyesea_api_results
     global eyesea_api_output
     global eyesea_api_indir
@@ -236,43 +513,20 @@ def save_results():
     else:
         outfile = eyesea_api_output
 
+    end = min(eyesea_api_end, len(eyesea_api_results.counts))
+    if sparse:
+        indices = eyesea_api_start + np.flatnonzero(eyesea_api_results.counts[eyesea_api_start:end])
+    else:
+        indices = range(eyesea_api_start, end)
+    frames = [_frame_json(i, eyesea_api_results.get(i).tolist()) for i in indices]
+    head = {'source': eyesea_api_indir, 'user': eyesea_api_alg, 'last_edit': ts.ctime(),
+            'nframes': end}
+    if eyesea_api_start:
+        head['start'] = eyesea_api_start
     with open(outfile,'w') as f:
-        f.write("{") # annotations
-        f.write(" \"source\": \"" + eyesea_api_indir.encode('unicode-escape').decode() + "\",\n")
-        f.write(" \"user\": \"" + eyesea_api_alg + "\",\n")
-        f.write(" \"last_edit\": \"" + ts.ctime() + "\",\n")
-        f.write(" \"frames\": [\n") # frameseyesea_api_results
-        
-        frames = eyesea_api_results
-        for i in range(len(frames)):
-            f.write(" {\n") # frame
-            f.write("  \"frameindex\": " + str(i) + ",\n")
-            f.write("  \"detections\": [\n") # detections
-                    
-            #for detection in frame.detections:
-            detections = frames[i]
-            for j in range(len(detections)):
-                f.write("  {\n") # detection
-                f.write("   \"x1\": " + str(detections[j].x1) + ",\n")
-                f.write("   \"y1\": " + str(detections[j].y1) + ",\n")
-                f.write("   \"x2\": " + str(detections[j].x2) + ",\n")
-                f.write("   \"y2\": " + str(detections[j].y2) + "\n")
-                f.write("  }")
-                if (j < len(detections) -1 ):
-                    f.write(",\n") # /detection
-                else:
-                    f.write("\n")
-            f.write("  ]\n") # /detections
-            f.write(" }")
-            if (i < len(frames)-1):
-                f.write(",\n")
-            else:
-                f.write("\n") # /frame
-        f.write(" ]\n") # /frames
-        
-        f.write("}\n") # /results
-        
-        
+        f.write(json.dumps(head)[:-1] + ', "frames": [\n' + ',\n'.join(frames) + '\n]}\n')
+
+
 # LEGACY ANNOTATION SUPPORT
 class Frame():
     def __init__(self, index, img, detections=list() ):
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# compare.py
+# Compare the median times of two reports written by run.py:
+#
+#   python compare.py results/before.json results/after.json
+#
+# A ratio below 1 means the second report is faster.
+import json
+import sys
+
+
+# name -> median seconds, nested results (cold/warm) are named name.cold
+def medians(report):
+    found = {}
+    for name, result in report['benchmarks'].items():
+        if 'median' in result:
+            found[name] = result['median']
+        for key, value in result.items():
+            if isinstance(value, dict) and 'median' in value:
+                found[name + '.' + key] = value['median']
+    return found
+
+
+def describe(report):
+    # + marks a report made with uncommitted changes
+    return '{}{}'.format((report.get('commit') or 'unknown')[:8], '+' if report.get('dirty') else '')
+
+
+def compare(old, new):
+    if old['parameters'] != new['parameters']:
+        print('Warning: the reports were made with different parameters')
+    a = medians(old)
+    b = medians(new)
+    print('{:32} {:>12} {:>12} {:>8}'.format('benchmark', describe(old), describe(new), 'ratio'))
+    for name in sorted(set(a) | set(b)):
+        ratio = b[name] / a[name] if name in a and name in b and a[name] else None
+        print('{:32} {:>12} {:>12} {:>8}'.format(
+            name,
+            '{:.4f}'.format(a[name]) if name in a else '-',
+            '{:.4f}'.format(b[name]) if name in b else '-',
+            '{:.2f}'.format(ratio) if ratio is not None else '-'))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print('usage: compare.py <report> <report>')
+        sys.exit(1)
+    compare(json.load(open(sys.argv[1])), json.load(open(sys.argv[2])))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# generate.py
+# Synthetic EyeSea datasets for the benchmarks.
+#
+# A workspace is laid out like the repository, so the server and the
+# algorithms can run in it unchanged:
+#
+# <work>
+#  |--algorithms (copy of ../algorithms)
+#  |--server/eyesea_settings.json
+#  |--storage/databases/bench.db
+#  |--storage/videos/video_NNNN.mp4 (copies of one short clip)
+#  |--storage/thumbnails/video_NNNN.jpg
+#  |--frames/clip/*.jpg (the clip as an image sequence)
+#  |--results/analysis.json (results file like eyesea_api.save_results())
+#  |--stereovision/YYYY_MM_DD/YYYY_MM_DD hh_mm_ss/Camera N/*.jpg
+#
+# Frames are a noisy background with bright blobs moving across it, so
+# background subtraction finds something.  Detections in the database are
+# random boxes: a frame has detections with probability density, with 1 to
+# boxes of them.  Everything is seeded, the same parameters give the same
+# workspace.
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repo, 'server'))
+
+defaults = {
+    'videos': 10,
+    'analyses': 2,
+    'frames': 3000,
+    'density': 0.3,
+    'boxes': 3,
+    'width': 640,
+    'height': 480,
+    'fps': 10,
+    'clip_frames': 100,
+    'blobs': 3,
+    'days': 1,
+    'times': 2,
+    'cameras': 2,
+    'seed': 1,
+}
+
+
+# one frame of the clip: background with noise and blobs moving left to right
+def draw_frame(rng, i, width, height, blobs):
+    img = np.full((height, width, 3), 60, np.uint8)
+    img += rng.randint(0, 20, img.shape).astype(np.uint8)
+    for b in range(blobs):
+        x = int((i * (3 + b) + b * width // max(blobs, 1)) % width)
+        y = int(height * (b + 1) / (blobs + 1) + 10 * np.sin(i / 7.0 + b))
+        cv2.ellipse(img, (x, y), (max(width // 40, 4), max(height // 60, 3)), 0, 0, 360, (230, 230, 230), -1)
+    return img
+
+
+# JPEG sequence named like the StereoVision cameras, returns the file names
+def make_frames(directory, n, width, height, blobs, seed, start=None):
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    start = start or datetime.datetime(2019, 10, 1, 12, 0, 0)
+    names = []
+    for i in range(n):
+        t = start + datetime.timedelta(seconds=i / 10.0)
+        name = os.path.join(directory, t.strftime('%Y_%m_%d_%H_%M_%S') + '.{:02d}.jpg'.format(t.microsecond // 10000))
+        cv2.imwrite(name, draw_frame(rng, i, width, height, blobs))
+        names.append(name)
+    return names
+
+
+def make_video(frames, path, fps):
+    first = cv2.imread(frames[0])
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (first.shape[1], first.shape[0]))
+    for f in frames:
+        writer.write(cv2.imread(f))
+    writer.release()
+
+
+# day/time/camera directories of the StereoVision system, with the settings
+# files stereovision_ingest.py looks for
+def make_stereovision(root, days, times, cameras, n, width, height, blobs, seed):
+    for d in range(days):
+        day = datetime.datetime(2019, 10, 1 + d, 12, 0, 0)
+        for t in range(times):
+            start = day + datetime.timedelta(minutes=5 * t)
+            timedir = os.path.join(root, day.strftime('%Y_%m_%d'), start.strftime('%Y_%m_%d %H_%M_%S'))
+            os.makedirs(timedir, exist_ok=True)
+            for pair in (1, 2):
+                with open(os.path.join(timedir, 'Camera Pair {} Settings.txt'.format(pair)), 'w') as f:
+                    f.write('{}\n\nFrame Rate 1 [Hz]: 10.00\nFrame Rate 2 [Hz]: 10.00\n'.format(start.ctime()))
+            for c in range(1, cameras + 1):
+                camdir = os.path.join(timedir, 'Camera {}'.format(c))
+                names = make_frames(camdir, n, width, height, blobs, seed + 100 * d + 10 * t + c, start)
+                with open(os.path.join(camdir, 'Timestamps.txt'), 'w') as f:
+                    f.write('\n'.join(os.path.basename(i) for i in names) + '\n')
+
+
+# sparse "frames" list of a results file, like eyesea_api.save_results()
+def synthetic_results(rng, frames, width, height, density, boxes):
+    results = []
+    for i in np.flatnonzero(rng.random_sample(frames) < density):
+        detections = []
+        for k in range(rng.randint(1, boxes + 1)):
+            w = rng.randint(10, max(width // 8, 11))
+            h = rng.randint(8, max(height // 8, 9))
+            x = rng.randint(0, width - w)
+            y = rng.randint(0, height - h)
+            detections.append({'x1': int(x), 'y1': int(y), 'x2': int(x + w), 'y2': int(y + h)})
+        results.append({'frameindex': int(i), 'detections': detections})
+    return results
+
+
+def write_results(path, frames, results):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'source': 'synthetic', 'user': 'generate.py', 'last_edit': time.ctime(),
+                   'nframes': frames, 'frames': results}, f)
+
+
+# settings of the workspace, paths are relative to <work>/server
+def write_settings(work, database):
+    settings = json.load(open(os.path.join(repo, 'server', 'eyesea_settings.json')))
+    for key, path in [('cache', 'thumbnails'), ('temporary_storage', '.tmp'), ('video_storage', 'videos'),
+                      ('video_overlay_storage', 'videos_overlayed'), ('csv_storage', 'detections'),
+                      ('database_storage', 'databases')]:
+        settings[key] = '../storage/' + path
+        os.makedirs(os.path.join(work, 'storage', path), exist_ok=True)
+    settings['algorithms'] = '../algorithms'
+    settings['database'] = database
+    settings['profiling'] = False
+    os.makedirs(os.path.join(work, 'server'), exist_ok=True)
+    with open(os.path.join(work, 'server', 'eyesea_settings.json'), 'w') as f:
+        json.dump(settings, f, indent=4)
+
+
+# database with videos whose analyses all have synthetic detections
+# clip is the video file of each video, algorithms the directory of bgMOG2
+def make_database(path, videos, analyses, clip, algorithms, p):
+    from eyesea_db import db, create_tables, video, analysis, analysis_method, store_results, update_statistics
+    rng = np.random.RandomState(p['seed'])
+    db.init(path)
+    create_tables()
+    with db.atomic():
+        method = json.load(open(os.path.join(repo, 'algorithms', 'bgMOG2.json')))
+        mid = analysis_method.insert(description=method['name'], automated=True, parameters=json.dumps(method),
+                                     path=algorithms, creation_date=int(time.time())).execute()
+        for v in range(videos):
+            vid = video.insert(description='synthetic {}'.format(v + 1), filename='video_{:04d}.mp4'.format(v + 1),
+                               fps=p['fps'], variable_framerate=0, duration=p['frames'] / p['fps'],
+                               uri='file://' + clip[v], creation_date=int(time.time()),
+                               width=p['width'], height=p['height']).execute()
+            for a in range(analyses):
+                aid = analysis.insert(mid=mid, vid=vid, status='FINISHED', parameters='',
+                                      results='').execute()
+                store_results(aid, synthetic_results(rng, p['frames'], p['width'], p['height'],
+                                                     p['density'], p['boxes']), p['frames'])
+            update_statistics(vid)
+    db.close()
+
+
+# Make a workspace in work from the parameters p (see defaults), returns
+# what the benchmarks need to know about it.
+def generate(work, p):
+    p = dict(defaults, **p)
+    work = os.path.abspath(work)
+    if os.path.exists(work):
+        shutil.rmtree(work)
+    shutil.copytree(os.path.join(repo, 'algorithms'), os.path.join(work, 'algorithms'),
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    write_settings(work, 'bench.db')
+    storage = os.path.join(work, 'storage')
+
+    frames = make_frames(os.path.join(work, 'frames', 'clip'), p['clip_frames'], p['width'], p['height'],
+                         p['blobs'], p['seed'])
+    clip = os.path.join(work, 'frames', 'clip.mp4')
+    make_video(frames, clip, p['fps'])
+    videos = []
+    for v in range(p['videos']):
+        name = 'video_{:04d}'.format(v + 1)
+        videos.append(os.path.join(storage, 'videos', name + '.mp4'))
+        shutil.copyfile(clip, videos[-1])
+        shutil.copyfile(frames[min(2, len(frames) - 1)], os.path.join(storage, 'thumbnails', name + '.jpg'))
+    make_database(os.path.join(storage, 'databases', 'bench.db'), p['videos'], p['analyses'], videos,
+                  os.path.join(work, 'algorithms'), p)
+
+    rng = np.random.RandomState(p['seed'] + 1)
+    write_results(os.path.join(work, 'results', 'analysis.json'), p['frames'],
+                  synthetic_results(rng, p['frames'], p['width'], p['height'], p['density'], p['boxes']))
+    make_stereovision(os.path.join(work, 'stereovision'), p['days'], p['times'], p['cameras'],
+                      p['clip_frames'], p['width'], p['height'], p['blobs'], p['seed'])
+
+    info = {'work': work, 'parameters': p, 'frames': os.path.join(work, 'frames', 'clip'), 'clip': clip,
+            'results': os.path.join(work, 'results', 'analysis.json')}
+    with open(os.path.join(work, 'workspace.json'), 'w') as f:
+        json.dump(info, f, indent=1)
+    return info
+
+
+# parameters on the command line of generate.py and run.py
+def add_arguments(parser):
+    parser.add_argument('--videos', type=int, default=defaults['videos'], help='videos in the database')
+    parser.add_argument('--analyses', type=int, default=defaults['analyses'], help='finished analyses per video')
+    parser.add_argument('--frames', type=int, default=defaults['frames'], help='frames processed per analysis')
+    parser.add_argument('--density', type=float, default=defaults['density'],
+                        help='fraction of frames with detections')
+    parser.add_argument('--boxes', type=int, default=defaults['boxes'], help='most detections in a frame')
+    parser.add_argument('--width', type=int, default=defaults['width'])
+    parser.add_argument('--height', type=int, default=defaults['height'])
+    parser.add_argument('--fps', type=int, default=defaults['fps'])
+    parser.add_argument('--clip-frames', type=int, default=defaults['clip_frames'],
+                        help='frames of the clip and of every StereoVision camera')
+    parser.add_argument('--blobs', type=int, default=defaults['blobs'], help='moving blobs in the frames')
+    parser.add_argument('--days', type=int, default=defaults['days'], help='StereoVision days')
+    parser.add_argument('--times', type=int, default=defaults['times'], help='StereoVision times per day')
+    parser.add_argument('--cameras', type=int, default=defaults['cameras'], help='StereoVision cameras per time')
+    parser.add_argument('--seed', type=int, default=defaults['seed'])
+
+
+def parameters(args):
+    return {k: getattr(args, k) for k in defaults}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic EyeSea workspace.')
+    parser.add_argument('work', help='workspace directory, replaced if it exists')
+    add_arguments(parser)
+    args = parser.parse_args()
+    start = time.time()
+    info = generate(args.work, parameters(args))
+    print('Generated {} in {:.1f}s'.format(info['work'], time.time() - start))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# run.py
+# Time the server routes, the algorithm API and the StereoVision ingest on a
+# synthetic workspace (see generate.py) and write a JSON report.
+#
+#   python run.py                       # generate in ./work and run everything
+#   python run.py --only get_video,write_csv --repeat 10
+#   python compare.py results/a.json results/b.json
+#
+# Routes are called in this process through the WSGI application of
+# eyesea_server.py, so the times include the hooks and plugins but no
+# network.  The server module patches the standard library with gevent when
+# it is imported, which is done only when a route benchmark runs.
+# bgMOG2 and stereovision_ingest.py run as they do in production, as
+# separate processes.
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import wsgiref.util
+
+import generate
+
+repo = generate.repo
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+# statistics of a list of times in seconds
+def summary(times, **extra):
+    times = sorted(times)
+    n = len(times)
+    median = times[n // 2] if n % 2 else (times[n // 2 - 1] + times[n // 2]) / 2
+    return dict({'unit': 's', 'repeat': n, 'min': times[0], 'median': median,
+                 'mean': sum(times) / n, 'max': times[-1], 'times': times}, **extra)
+
+
+def timed(f, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+# the server, imported from the repository with the workspace as its
+# working directory, like eyesea_server.py is run from server/
+server = None
+
+
+def load_server(work):
+    global server
+    if server is None:
+        os.chdir(os.path.join(work, 'server'))
+        sys.path.insert(0, os.path.join(repo, 'server'))
+        import eyesea_server
+        server = eyesea_server
+    return server
+
+
+# GET path through the WSGI application, returns the body
+def get(path, query=''):
+    environ = {}
+    wsgiref.util.setup_testing_defaults(environ)
+    environ.update({'PATH_INFO': path, 'QUERY_STRING': query, 'REQUEST_METHOD': 'GET',
+                    'CONTENT_TYPE': 'application/json', 'wsgi.errors': io.StringIO()})
+    status = []
+    body = b''.join(server.app(environ, lambda s, headers, exc_info=None: status.append(s)))
+    if not status[0].startswith('200'):
+        raise RuntimeError('GET {} returned {}'.format(path, status[0]))
+    return body
+
+
+# cached heatmaps and grids of the workspace, removed for cold runs
+def clear_heatmaps():
+    for f in os.listdir(server.cache):
+        if '_heatmap_' in f:
+            os.remove(os.path.join(server.cache, f))
+    shutil.rmtree(server.gridstore, ignore_errors=True)
+
+
+def bench_get_video(info, repeat):
+    get('/video')
+    return summary(timed(lambda: get('/video'), repeat), videos=info['parameters']['videos'])
+
+
+def bench_get_video_vid(info, repeat):
+    return summary(timed(lambda: get('/video/1'), repeat))
+
+
+def bench_video_heatmap_json(info, repeat):
+    return {
+        'cold': summary(timed(lambda: get('/video/1/heatmap/json'), repeat, clear_heatmaps)),
+        'warm': summary(timed(lambda: get('/video/1/heatmap/json'), repeat)),
+    }
+
+
+def bench_video_statistics(info, repeat):
+    def clear():
+        with server.db.using(server.db.database):
+            server.video_stats.delete().execute()
+    return {
+        'cold': summary(timed(lambda: get('/video/1/statistics'), repeat, clear)),
+        'warm': summary(timed(lambda: get('/video/1/statistics'), repeat)),
+    }
+
+
+def bench_write_csv(info, repeat):
+    size = len(get('/video/1/video.csv'))
+    return summary(timed(lambda: get('/video/1/video.csv'), repeat), bytes=size)
+
+
+# a results file parsed and stored like the reaper does when an analysis ends
+def bench_ingest(info, repeat):
+    s = server
+
+    def ingest():
+        with s.db.using(s.db.database):
+            aid = s.analysis.insert(mid=1, vid=1, status='PROCESSING', parameters='', results='').execute()
+            with s.db.atomic():
+                s.ingest_analysis(aid, {'outputs': [info['results']]}, 0)
+            s.detection.delete().where(s.detection.aid == aid).execute()
+            s.analysis.delete().where(s.analysis.aid == aid).execute()
+            s.update_statistics(1)
+    return summary(timed(ingest, repeat), frames=info['parameters']['frames'])
+
+
+# frames of the clip read with eyesea_api.get_frame(), in this process, from
+# the image sequence or from the video file
+def bench_get_frame(info, repeat, source='frames'):
+    sys.path.insert(0, os.path.join(info['work'], 'algorithms'))
+    import eyesea_api as api
+    argv = sys.argv
+    sys.argv = ['bench', info[source], os.path.join(info['work'], 'results', 'get_frame.json')]
+    try:
+        api.get_args(os.path.join(info['work'], 'algorithms', 'bgMOG2.json'))
+    finally:
+        sys.argv = argv
+
+    def read():
+        api.rewind()
+        frame, idx = api.get_frame()
+        while len(frame):
+            frame, idx = api.get_frame()
+    times = timed(read, repeat)
+    n = api.nframes()
+    return summary(times, frames=n, fps=n / min(times))
+
+
+# bgMOG2 on the clip as a process, including its start-up
+def bench_bgmog2(info, repeat):
+    algorithms = os.path.join(info['work'], 'algorithms')
+    output = os.path.join(info['work'], 'results', 'bgMOG2.json')
+
+    def run():
+        subprocess.check_call([sys.executable, 'bgMOG2.py', info['frames'], output], cwd=algorithms,
+                              stdout=subprocess.DEVNULL)
+    times = timed(run, repeat)
+    n = info['parameters']['clip_frames']
+    return summary(times, frames=n, fps=n / min(times))
+
+
+# stereovision_ingest.py end to end on the StereoVision tree, once: it makes
+# movies, runs bgMOG2 on every camera and fills a database per day
+def bench_stereovision_ingest(info, repeat):
+    if not shutil.which('ffmpeg'):
+        return {'skipped': 'ffmpeg is not installed'}
+    work = info['work']
+    for f in os.listdir(os.path.join(work, 'storage', 'databases')):
+        if f.startswith('svbench-'):
+            os.remove(os.path.join(work, 'storage', 'databases', f))
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, os.path.join(repo, 'server', 'stereovision_ingest.py'),
+                           '-d', os.path.join(work, 'stereovision'), '-p', 'svbench', '-f'],
+                          cwd=os.path.join(work, 'server'), stdout=subprocess.DEVNULL)
+    p = info['parameters']
+    return summary([time.perf_counter() - start],
+                   videos=p['days'] * p['times'] * p['cameras'], frames=p['clip_frames'])
+
+
+# name -> (function, needs the server)
+benchmarks = [
+    ('get_video', bench_get_video, True),
+    ('get_video_vid', bench_get_video_vid, True),
+    ('video_heatmap_json', bench_video_heatmap_json, True),
+    ('video_statistics', bench_video_statistics, True),
+    ('write_csv', bench_write_csv, True),
+    ('ingest', bench_ingest, True),
+    ('get_frame', bench_get_frame, False),
+    ('get_frame_video', lambda info, repeat: bench_get_frame(info, repeat, 'clip'), False),
+    ('bgMOG2', bench_bgmog2, False),
+    ('stereovision_ingest', bench_stereovision_ingest, False),
+]
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                             cwd=repo, stderr=subprocess.DEVNULL).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the EyeSea benchmarks.')
+    parser.add_argument('--work', default=os.path.join(here, 'work'), help='workspace directory')
+    parser.add_argument('--reuse', action='store_true',
+                        help='use the workspace as it is instead of generating it again')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark')
+    parser.add_argument('--only', help='comma separated benchmarks to run')
+    parser.add_argument('--output', help='report file, by default results/<time>-<commit>.json')
+    generate.add_arguments(parser)
+    args = parser.parse_args()
+
+    names = [b[0] for b in benchmarks]
+    selected = args.only.split(',') if args.only else names
+    unknown = set(selected) - set(names)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+    work = os.path.abspath(args.work)
+    if args.reuse and os.path.isfile(os.path.join(work, 'workspace.json')):
+        info = json.load(open(os.path.join(work, 'workspace.json')))
+    else:
+        print('Generating workspace in {}'.format(work))
+        info = generate.generate(work, generate.parameters(args))
+
+    commit, dirty = git_commit()
+    report = {
+        'created': datetime.datetime.now().isoformat(),
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': info['parameters'],
+        'repeat': args.repeat,
+        'benchmarks': {},
+    }
+    for name, f, needs_server in benchmarks:
+        if name not in selected:
+            continue
+        print('{} ...'.format(name), end=' ', flush=True)
+        try:
+            # the server logs every cache access
+            with contextlib.redirect_stdout(io.StringIO()):
+                if needs_server:
+                    load_server(work)
+                result = f(info, args.repeat)
+        except Exception as e:
+            result = {'error': '{}: {}'.format(e.__class__.__name__, e)}
+        report['benchmarks'][name] = result
+        print(json.dumps({k: v for k, v in result.items() if k != 'times'}, default=str)[:200])
+
+    output = args.output or os.path.join(here, 'results', '{}-{}.json'.format(
+        time.strftime('%Y%m%d-%H%M%S'), (commit or 'unknown')[:8] + ('-dirty' if dirty else '')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Report written to {}'.format(output))
+    # the server's greenlets and render workers don't need a clean shutdown
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
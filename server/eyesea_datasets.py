@@ -0,0 +1,151 @@
+# eyesea_datasets.py
+# Queries over many datasets at once.
+#
+# stereovision_ingest.py writes one database per day, named
+# <prefix>-YYYY_MM_DD.db.  Each database file is summarized on its own in a
+# pool of threads (SQLite doesn't hold the GIL while it reads, so several
+# files are read at the same time) and the summaries are combined here.
+# A summary is kept until the file, or its write-ahead log, is modified.
+import datetime
+import os
+import re
+
+from gevent.threadpool import ThreadPool
+from peewee import fn, JOIN, SqliteDatabase
+
+from eyesea_db import video, analysis, analysis_method, detection, migrate_file
+
+day_pattern = re.compile(r'(\d{4})_(\d{2})_(\d{2})$')
+# stereovision_ingest.py names videos <time>_Cam<camera>.mp4
+camera_pattern = re.compile(r'_Cam(\d+)$')
+
+
+# date of a dataset named <prefix>-YYYY_MM_DD, or None
+def dataset_date(name):
+    m = day_pattern.search(name)
+    if not m:
+        return None
+    try:
+        return datetime.date(*[int(i) for i in m.groups()])
+    except ValueError:
+        return None
+
+
+# YYYY-MM-DD or YYYY_MM_DD, raises ValueError
+def parse_date(s):
+    return datetime.datetime.strptime(s.replace('_', '-'), '%Y-%m-%d').date()
+
+
+# (name, path, date) of the database files in dbdir, ordered by date then
+# name.  With start or end only the days between them (inclusive) are
+# returned, with prefix only the files named <prefix>-...
+def find_datasets(dbdir, start=None, end=None, prefix=None):
+    found = []
+    for f in os.listdir(dbdir):
+        name, ext = os.path.splitext(f)
+        if ext != '.db' or (prefix and not name.startswith(prefix + '-')):
+            continue
+        date = dataset_date(name)
+        if (start or end) and (date is None or (start and date < start) or (end and date > end)):
+            continue
+        found.append((name, os.path.join(dbdir, f), date))
+    found.sort(key=lambda d: (d[2] or datetime.date.min, d[0]))
+    return found
+
+
+# changes whenever the database is written to
+def file_key(path):
+    wal = path + '-wal'
+    return (os.path.getmtime(path), os.path.getsize(path),
+            os.path.getmtime(wal) if os.path.exists(wal) else 0)
+
+
+count_keys = ('videos', 'analyses', 'frames', 'detections', 'framesWithDetections')
+method_keys = ('analyses', 'detections', 'framesWithDetections')
+
+
+def _counts(keys=count_keys):
+    return {k: 0 for k in keys}
+
+
+# add the counts of b to a
+def _add(a, b, keys=count_keys):
+    for k in keys:
+        a[k] += b[k]
+    return a
+
+
+# Counts of the finished analyses in one database file, in total, by camera
+# and by method.  frames is the number of frames processed, per video the
+# largest of its analyses; framesWithDetections counts a frame once for
+# every analysis with detections in it.  Runs in a worker thread, so it
+# uses its own connection and queries bound to it.
+def summarize(path):
+    # older files get the detection table before they can be summarized
+    migrate_file(path)
+    database = SqliteDatabase(path)
+    with database.connection_context():
+        cameras = {}
+        for vid, filename in video.select(video.vid, video.filename).tuples().bind(database):
+            m = camera_pattern.search(os.path.splitext(os.path.basename(filename))[0])
+            cameras[vid] = m.group(1) if m else 'other'
+        query = analysis.select(analysis.vid, analysis.mid, analysis.nframes, analysis_method.description,
+                                fn.COUNT(detection.did).alias('detections'),
+                                fn.COUNT(fn.DISTINCT(detection.frameindex)).alias('frames')).join(
+            analysis_method, JOIN.LEFT_OUTER, on=(analysis.mid == analysis_method.mid)).switch(
+            analysis).join(detection, JOIN.LEFT_OUTER, on=(detection.aid == analysis.aid)).where(
+            analysis.status == 'FINISHED').group_by(analysis.aid).tuples().bind(database)
+        analyses = list(query)
+    database.close()
+
+    total = _counts()
+    by_camera = {}
+    by_method = {}
+    frames = {}
+    for vid, camera in cameras.items():
+        by_camera.setdefault(camera, _counts())['videos'] += 1
+        total['videos'] += 1
+    for vid, mid, nframes, name, count, frames_with_detections in analyses:
+        frames[vid] = max(frames.get(vid, 0), nframes or 0)
+        counts = {'videos': 0, 'analyses': 1, 'frames': 0, 'detections': count,
+                  'framesWithDetections': frames_with_detections}
+        _add(total, counts)
+        _add(by_camera.setdefault(cameras.get(vid, 'other'), _counts()), counts)
+        method = by_method.setdefault(str(mid), dict(_counts(method_keys), name=name))
+        _add(method, counts, method_keys)
+    for vid, n in frames.items():
+        total['frames'] += n
+        by_camera.setdefault(cameras.get(vid, 'other'), _counts())['frames'] += n
+    return dict(total, cameras=by_camera, methods=by_method)
+
+
+# summaries of database files by path, computed in a pool of threads
+class summary_cache():
+    def __init__(self, workers=4):
+        self.pool = ThreadPool(max(1, int(workers)))
+        # path -> (file_key(), summary)
+        self.entries = {}
+
+    # summaries of paths, in the same order
+    def get(self, paths):
+        pending = {}
+        for path in paths:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != file_key(path):
+                pending[path] = (file_key(path), self.pool.spawn(summarize, path))
+        for path, (key, result) in pending.items():
+            self.entries[path] = (key, result.get())
+        return [self.entries[path][1] for path in paths]
+
+
+# combine summaries, the cameras and methods are merged by key
+def combine(summaries):
+    total = dict(_counts(), cameras={}, methods={})
+    for s in summaries:
+        _add(total, s)
+        for camera, counts in s['cameras'].items():
+            _add(total['cameras'].setdefault(camera, _counts()), counts)
+        for mid, counts in s['methods'].items():
+            method = total['methods'].setdefault(mid, dict(_counts(method_keys), name=counts['name']))
+            _add(method, counts, method_keys)
+    return total
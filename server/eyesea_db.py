@@ -1,11 +1,127 @@
 #!/usr/bin/env python
 import json # settings file
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
 from peewee import * # database connection
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.pool import PooledSqliteDatabase
+
+import eyesea_metrics as metrics
+
+# WAL lets the server read while an analysis is being written.  With WAL,
+# synchronous=NORMAL only risks the last transactions on a power loss, not
+# corruption.  cache_size is in KiB when negative.
+pragmas = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -32 * 1024),
+    ('mmap_size', 256 * 1024 * 1024),
+]
+
+# Statements are timed by their first word (SELECT, INSERT, ...).  SELECTs
+# are timed up to their first row, the rest is read as the cursor is used.
+class timed_database(PooledSqliteDatabase):
+    def execute_sql(self, sql, *args, **kwargs):
+        with metrics.queries.time(statement=sql.split(None, 1)[0].upper() if sql else ''):
+            return super().execute_sql(sql, *args, **kwargs)
+
+# Every dataset is a database file.  The models use a router that sends
+# queries to the dataset of the current request, or greenlet, so clients can
+# work on different datasets at the same time.  Each dataset file has its
+# own pool of connections; at most max_datasets of them are kept open, the
+# least recently used idle one is closed when another one is opened.
+class dataset_router():
+    def __init__(self, max_datasets=8, max_connections=20):
+        self.max_datasets = max_datasets
+        self.max_connections = max_connections
+        self.pragmas = pragmas
+        # path -> database, least recently used first
+        self.databases = OrderedDict()
+        # used when no dataset was selected, set by init()
+        self.default = None
+        self.local = threading.local()
+
+    def _create(self, path):
+        return timed_database(path, max_connections=self.max_connections, pragmas=self.pragmas)
+
+    # the database of a dataset file
+    def open(self, path):
+        path = os.path.abspath(path)
+        if self.default is not None and self.default.database == path:
+            return self.default
+        database = self.databases.pop(path, None)
+        if database is None:
+            # only pools with no connections in use are closed, least
+            # recently used first; busy pools stay until a later open
+            for old in [p for p, d in self.databases.items() if not d._in_use]:
+                if len(self.databases) < self.max_datasets:
+                    break
+                self.databases.pop(old).close_all()
+            database = self._create(path)
+        self.databases[path] = database
+        return database
+
+    # set the default dataset, like SqliteDatabase.init()
+    def init(self, path):
+        path = os.path.abspath(path)
+        self.default = self.databases.pop(path, None) or self._create(path)
+
+    # select the dataset of the current greenlet, None for the default
+    def use(self, path):
+        self.local.database = self.open(path) if path else None
+
+    # work on another dataset for a while, with a connection that is only
+    # closed afterwards if it wasn't already open
+    @contextmanager
+    def using(self, path):
+        previous = getattr(self.local, 'database', None)
+        database = self.local.database = self.open(path)
+        opened = database.is_closed() and database.connect()
+        try:
+            yield database
+        finally:
+            if opened:
+                database.close()
+            self.local.database = previous
+
+    # send the queries of the current greenlet or thread to a database that
+    # the router doesn't keep, e.g. one opened by a worker thread
+    @contextmanager
+    def bound(self, database):
+        previous = getattr(self.local, 'database', None)
+        self.local.database = database
+        try:
+            yield database
+        finally:
+            self.local.database = previous
+
+    def current(self):
+        database = getattr(self.local, 'database', None) or self.default
+        if database is None:
+            raise InterfaceError('No dataset selected, call db.init() first.')
+        return database
+
+    # BlobField asks for it when the models are defined, before any dataset
+    # is selected; all datasets are SQLite
+    def get_binary_type(self):
+        return sqlite3.Binary
+
+    def __getattr__(self, attr):
+        return getattr(self.current(), attr)
+
+    def __enter__(self):
+        return self.current().__enter__()
+
+    def __exit__(self, *args):
+        return self.current().__exit__(*args)
 
-#settings = json.loads(open('eyesea_settings.json').read())
-#db = SqliteDatabase(settings['database'])
 # importing module sets db
-db = SqliteDatabase(None)
+db = dataset_router()
 
 class eyesea_model(Model):
     class Meta:
@@ -38,7 +154,26 @@ class analysis(eyesea_model):
     vid = IntegerField()
     status = CharField()
     parameters = TextField()
+    # legacy JSON results, detections are stored in the detection table
     results = TextField()
+    # number of frames processed, frames without detections are not stored
+    nframes = IntegerField(null=True)
+    # incremented every time the detections change, used as a cache key
+    version = IntegerField(default=0)
+
+class detection(eyesea_model):
+    did = IntegerField(primary_key=True)
+    aid = IntegerField()
+    frameindex = IntegerField()
+    x1 = IntegerField()
+    y1 = IntegerField()
+    x2 = IntegerField()
+    y2 = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('aid', 'frameindex'), False),
+        )
 
 class analysis_method(eyesea_model):
     mid = IntegerField(primary_key=True)
@@ -48,6 +183,390 @@ class analysis_method(eyesea_model):
     path = TextField()
     creation_date = IntegerField()
 
+# Statistics of a video over its finished analyses, computed by
+# update_statistics() when they change instead of on every request.
+class video_stats(eyesea_model):
+    vid = IntegerField(primary_key=True)
+    # largest number of frames processed by one of the analyses
+    frames = IntegerField(default=0)
+    analyses = IntegerField(default=0)
+    total_detections = IntegerField(default=0)
+    # a frame counts once for every analysis with detections in it
+    frames_with_detections = IntegerField(default=0)
+    # the length of a box is its longer side
+    min_length = IntegerField(default=0)
+    sum_length = IntegerField(default=0)
+    max_length = IntegerField(default=0)
+    # frame with the most detections of a single analysis
+    peak_frame = IntegerField(default=0)
+    peak_detections = IntegerField(default=0)
+    # JSON list of the same statistics for each analysis
+    methods = TextField(default='[]')
+    updated = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'video_statistics'
+
+# Log of the edits made to single detections by edit_detection().  The
+# detection table is changed right away, the log keeps what has to be
+# folded into the statistics and heatmaps, see pending_edits().
+class detection_edit(eyesea_model):
+    eid = IntegerField(primary_key=True)
+    aid = IntegerField()
+    did = IntegerField()
+    # 'add', 'move' or 'delete'
+    op = CharField()
+    # version of the analysis before the edit
+    version = IntegerField()
+    # JSON {'frameindex':, 'x1':, 'y1':, 'x2':, 'y2':} of the detection
+    # before (move, delete) and after (add, move) the edit
+    before = TextField(null=True)
+    after = TextField(null=True)
+
+    class Meta:
+        indexes = (
+            (('aid', 'eid'), False),
+        )
+
+tables = [video, analysis, analysis_method, detection, video_stats, detection_edit]
+
 def create_tables():
     with db:
-        db.create_tables([video, analysis, analysis_method])
+        db.create_tables(tables)
+
+# SQLite limits the number of variables in one statement to 999, inserts and
+# IN (...) lists are split into batches
+batch_size = 999 // 6
+
+column_type = np.dtype('<i4')
+
+# The detections of an analysis as columns of int32, for reading whole
+# analyses without going through a row per detection: frames are the
+# indexes of the frames with detections in order, the boxes (x1, y1, x2, y2)
+# of frames[i] are rows offsets[i] to offsets[i + 1] of boxes, and dids
+# has the detection id of every box.  rows are (frameindex, x1, y1, x2, y2,
+# did) in frame order.
+def make_columns(rows):
+    rows = np.array(rows, dtype=column_type).reshape(-1, 6)
+    frames, starts = np.unique(rows[:, 0], return_index=True)
+    return {
+        'frames': frames.astype(column_type),
+        'offsets': np.append(starts, len(rows)).astype(column_type),
+        'boxes': np.ascontiguousarray(rows[:, 1:5]),
+        'dids': np.ascontiguousarray(rows[:, 5]),
+    }
+
+# Columns are only kept in memory, the detection rows are the stored form.
+# Entries are keyed by dataset file and aid and hold the version of the
+# analysis they were made from; at most max_bytes of arrays are kept, the
+# least recently used are dropped first.
+class column_cache():
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # (dataset path, aid) -> (version, columns), least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, key, version):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] != version:
+            self.bytes -= column_bytes(entry[1])
+            return None
+        self.entries[key] = entry
+        return entry[1]
+
+    def put(self, key, version, columns):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= column_bytes(old[1])
+        self.entries[key] = (version, columns)
+        self.bytes += column_bytes(columns)
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            self.bytes -= column_bytes(self.entries.popitem(last=False)[1][1])
+
+def column_bytes(columns):
+    return sum(c.nbytes for c in columns.values())
+
+cached_columns = column_cache()
+
+# Columns of many analyses, as dicts of read-only arrays by aid.  Analyses
+# that aren't cached, or changed since, are read from their detection rows.
+def load_columns_many(aids):
+    dataset = db.current().database
+    # what is read inside a transaction that may still be rolled back isn't
+    # cached
+    cache = not db.in_transaction()
+    with db.atomic():
+        versions = {}
+        for i in range(0, len(aids), batch_size):
+            versions.update(analysis.select(analysis.aid, analysis.version).where(
+                analysis.aid.in_(aids[i:i + batch_size])).tuples())
+        found = {}
+        for aid in aids:
+            c = cached_columns.get((dataset, aid), versions.get(aid))
+            metrics.cache_lookup('columns', c is not None)
+            if c is not None:
+                found[aid] = c
+        missing = [aid for aid in aids if aid not in found]
+        rows = {aid: [] for aid in missing}
+        for i in range(0, len(missing), batch_size):
+            query = detection.select(detection.aid, detection.frameindex, detection.x1, detection.y1,
+                                     detection.x2, detection.y2, detection.did).where(
+                detection.aid.in_(missing[i:i + batch_size])).order_by(
+                detection.aid, detection.frameindex, detection.did).tuples()
+            for row in query:
+                rows[row[0]].append(row[1:])
+    for aid in missing:
+        c = make_columns(rows[aid])
+        for a in c.values():
+            a.flags.writeable = False
+        if cache and aid in versions:
+            cached_columns.put((dataset, aid), versions[aid], c)
+        found[aid] = c
+    return found
+
+def load_columns(aid):
+    return load_columns_many([aid])[aid]
+
+# frame index of every detection of frames start to end - 1, its box and
+# its did
+def window_columns(columns, start, end):
+    frames, offsets = columns['frames'], columns['offsets']
+    i, j = np.searchsorted(frames, [start, end])
+    j = max(i, j)
+    counts = np.diff(offsets[i:j + 1])
+    return (np.repeat(frames[i:j], counts), columns['boxes'][offsets[i]:offsets[j]],
+            columns['dids'][offsets[i]:offsets[j]])
+
+# Replace the detections of an analysis.
+# frames is the "frames" list written by eyesea_api.save_results():
+# [{'frameindex': 0, 'detections': [{'x1':, 'y1':, 'x2':, 'y2':}, ...]}, ...]
+# either every frame or, with nframes, only the frames with detections.
+# Stored detections keep their did: a detection with the 'did' it was
+# loaded with by load_results() is updated in place, one without takes the
+# did of an equal stored detection.  The rest are inserted and the stored
+# detections left over are deleted.
+def store_results(aid, frames, nframes=None):
+    rows = [(d.get('did'), int(f['frameindex']), int(round(d['x1'])), int(round(d['y1'])),
+             int(round(d['x2'])), int(round(d['y2'])))
+            for f in frames for d in f['detections']]
+    if nframes is None:
+        nframes = max([len(frames)] + [int(f['frameindex']) + 1 for f in frames[-1:]])
+    fields = [detection.frameindex, detection.x1, detection.y1, detection.x2, detection.y2]
+    with db.atomic():
+        stored = {r[0]: r[1:] for r in detection.select(detection.did, *fields).where(
+            detection.aid == aid).tuples()}
+        kept = set()
+        moved = []
+        unmatched = []
+        for row in rows:
+            did, value = row[0], row[1:]
+            if did in stored and did not in kept:
+                kept.add(did)
+                if stored[did] != value:
+                    moved.append((did, value))
+            else:
+                unmatched.append(value)
+        # dids of the stored detections not kept yet, by value
+        free = {}
+        for did in sorted(stored):
+            if did not in kept:
+                free.setdefault(stored[did], []).append(did)
+        added = []
+        for value in unmatched:
+            if free.get(value):
+                kept.add(free[value].pop(0))
+            else:
+                added.append((aid,) + value)
+        removed = [did for did in stored if did not in kept]
+        for i in range(0, len(removed), batch_size):
+            detection.delete().where(detection.did.in_(removed[i:i + batch_size])).execute()
+        for did, value in moved:
+            detection.update(dict(zip(fields, value))).where(detection.did == did).execute()
+        for i in range(0, len(added), batch_size):
+            detection.insert_many(added[i:i + batch_size], fields=[detection.aid] + fields).execute()
+        analysis.update({'results': '', 'nframes': nframes, 'version': analysis.version + 1}).where(
+            analysis.aid == aid).execute()
+
+# Add, move or delete one detection of a finished analysis.  box is a dict
+# with x1, y1, x2 and y2, needed to add or move; frameindex is needed to
+# add, a moved detection stays in its frame unless it is given.
+# Returns (did, version of the analysis), or None if the analysis or the
+# detection doesn't exist.
+def edit_detection(aid, op, did=None, frameindex=None, box=None):
+    with db.atomic():
+        a = analysis.select(analysis.nframes, analysis.version).where(
+            analysis.aid == aid, analysis.status == 'FINISHED').dicts().first()
+        if a is None:
+            return None
+        before = after = None
+        if op != 'add':
+            before = detection.select(detection.frameindex, detection.x1, detection.y1,
+                                      detection.x2, detection.y2).where(
+                detection.did == did, detection.aid == aid).dicts().first()
+            if before is None:
+                return None
+        if op != 'delete':
+            after = {k: int(round(box[k])) for k in ('x1', 'y1', 'x2', 'y2')}
+            after['frameindex'] = before['frameindex'] if frameindex is None else int(frameindex)
+        if op == 'add':
+            did = detection.insert(dict(after, aid=aid)).execute()
+        elif op == 'move':
+            detection.update(after).where(detection.did == did).execute()
+        else:
+            detection.delete().where(detection.did == did).execute()
+        detection_edit.insert({'aid': aid, 'did': did, 'op': op, 'version': a['version'],
+                               'before': json.dumps(before) if before else None,
+                               'after': json.dumps(after) if after else None}).execute()
+        nframes = a['nframes'] or 0
+        if after:
+            nframes = max(nframes, after['frameindex'] + 1)
+        analysis.update({'nframes': nframes, 'version': analysis.version + 1}).where(
+            analysis.aid == aid).execute()
+    return did, a['version'] + 1
+
+# Edits in the log, by aid in the order they were made, of the analyses of
+# a video or of all analyses.
+def pending_edits(vid=None):
+    query = detection_edit.select(detection_edit.eid, detection_edit.aid, detection_edit.op,
+                                  detection_edit.version, detection_edit.before, detection_edit.after)
+    if vid is not None:
+        query = query.join(analysis, on=(analysis.aid == detection_edit.aid)).where(
+            analysis.vid == vid)
+    edits = {}
+    for e in query.order_by(detection_edit.eid).dicts():
+        edits.setdefault(e['aid'], []).append(e)
+    return edits
+
+# remove the edits of an analysis up to eid from the log
+def clear_edits(aid, eid):
+    detection_edit.delete().where(detection_edit.aid == aid, detection_edit.eid <= eid).execute()
+
+# Inverse of store_results(), one entry per frame including empty frames.
+def load_results(aid, nframes=None):
+    if nframes is None:
+        nframes = analysis.select(analysis.nframes).where(
+            analysis.aid == aid).scalar() or 0
+    return load_results_many({aid: nframes})[aid]
+
+# load_results() for many analyses, from their columns
+# nframes is a dict of aid -> number of frames
+def load_results_many(nframes):
+    columns = load_columns_many(list(nframes))
+    results = {}
+    for aid, n in nframes.items():
+        c = columns[aid]
+        indexes = c['frames'].tolist()
+        offsets = c['offsets'].tolist()
+        boxes = [{'did': did, 'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}
+                 for (x1, y1, x2, y2), did in zip(c['boxes'].tolist(), c['dids'].tolist())]
+        frames = [{'frameindex': i, 'detections': []}
+                  for i in range(max([n or 0] + [f + 1 for f in indexes[-1:]]))]
+        for i, f in enumerate(indexes):
+            frames[f]['detections'] = boxes[offsets[i]:offsets[i + 1]]
+        results[aid] = frames
+    return results
+
+# Recompute the statistics of a video, after an analysis of it finished or
+# its detections were edited.
+def update_statistics(vid):
+    methods = [{'id': aid, 'method': mid, 'frames': nframes or 0, 'detections': 0,
+                'framesWithDetections': 0, 'minLength': 0, 'sumLength': 0, 'maxLength': 0,
+                'peakFrame': 0, 'peakDetections': 0}
+               for aid, mid, nframes in analysis.select(analysis.aid, analysis.mid, analysis.nframes).where(
+                   analysis.vid == vid, analysis.status == 'FINISHED').order_by(analysis.aid).tuples()]
+    stats = {m['id']: m for m in methods}
+    aids = list(stats.keys())
+    length = fn.MAX(fn.ABS(detection.x2 - detection.x1), fn.ABS(detection.y2 - detection.y1))
+    for i in range(0, len(aids), batch_size):
+        query = detection.select(detection.aid, detection.frameindex, fn.COUNT(detection.did),
+                                 fn.MIN(length), fn.SUM(length), fn.MAX(length)).where(
+            detection.aid.in_(aids[i:i + batch_size])).group_by(
+            detection.aid, detection.frameindex).order_by(detection.aid, detection.frameindex).tuples()
+        for aid, frameindex, count, min_length, sum_length, max_length in query:
+            m = stats[aid]
+            m['minLength'] = min(m['minLength'], min_length) if m['detections'] else min_length
+            m['detections'] += count
+            m['framesWithDetections'] += 1
+            m['sumLength'] += sum_length
+            m['maxLength'] = max(m['maxLength'], max_length)
+            if count > m['peakDetections']:
+                m['peakFrame'], m['peakDetections'] = frameindex, count
+    found = [m for m in methods if m['detections']]
+    peak = max(methods, key=lambda m: m['peakDetections']) if methods else {}
+    video_stats.insert({
+        'vid': vid,
+        'frames': max([m['frames'] for m in methods] + [0]),
+        'analyses': len(methods),
+        'total_detections': sum(m['detections'] for m in methods),
+        'frames_with_detections': sum(m['framesWithDetections'] for m in methods),
+        'min_length': min([m['minLength'] for m in found] or [0]),
+        'sum_length': sum(m['sumLength'] for m in methods),
+        'max_length': max([m['maxLength'] for m in methods] + [0]),
+        'peak_frame': peak.get('peakFrame', 0),
+        'peak_detections': peak.get('peakDetections', 0),
+        'methods': json.dumps(methods),
+        'updated': int(time.time())
+    }).on_conflict_replace().execute()
+
+# Bring a database created by an older version up to date: adds the
+# detection table and moves JSON analysis.results into it.
+def migrate_database():
+    with db.atomic():
+        db.create_tables(tables)
+        columns = [c.name for c in db.get_columns('analysis')]
+        if 'nframes' not in columns:
+            migrate(SqliteMigrator(db).add_column('analysis', 'nframes', analysis.nframes))
+        if 'version' not in columns:
+            migrate(SqliteMigrator(db).add_column('analysis', 'version', analysis.version))
+        # columns of the detections were kept in this table, they are only
+        # cached in memory now
+        if 'result_columns' in db.get_tables():
+            db.execute_sql('DROP TABLE result_columns')
+        legacy = analysis.select(analysis.aid, analysis.results).where(
+            analysis.results != '').tuples()
+        for aid, results in legacy:
+            try:
+                frames = json.loads(results)
+            except ValueError:
+                print('Unable to migrate results of analysis {}'.format(aid))
+                continue
+            nframes = None
+            if isinstance(frames, dict):
+                nframes = frames.get('nframes')
+                frames = frames.get('frames', [])
+            store_results(aid, frames, nframes)
+
+# paths of the datasets brought up to date by open_dataset()
+migrated = set()
+
+# The database of another dataset file, migrated the first time it is
+# opened.  Queries on it either run in db.using(path) or are bound to it.
+def open_dataset(path):
+    with db.using(path) as database:
+        if database.database not in migrated:
+            migrate_database()
+            migrated.add(database.database)
+    return database
+
+# Bring a dataset file up to date from a worker thread, with a connection of
+# its own instead of a pool of the router, so the datasets the router keeps
+# open are left alone.  Files already opened by open_dataset() are skipped.
+def migrate_file(path):
+    path = os.path.abspath(path)
+    if path in migrated:
+        return
+    database = SqliteDatabase(path, pragmas=db.pragmas)
+    with db.bound(database), database.connection_context():
+        migrate_database()
+
+if __name__ == "__main__":
+    import sys
+    # python eyesea_db.py <database.db> [<database.db> ...]
+    for path in sys.argv[1:]:
+        print('Migrating ' + path)
+        db.init(path)
+        migrate_database()
+        db.close()
@@ -0,0 +1,200 @@
+# eyesea_export.py
+# Streaming exports of the detections of analyses.
+#
+# Every export is a generator of str or bytes chunks that bottle sends while
+# it is being produced.  Detections are read in pages of page_size, each
+# page with its own connection, so no cursor is held open while waiting on
+# a slow client and memory use doesn't depend on the size of the export.
+#
+# ZIP archives are written by zipfile into a buffer that is emptied after
+# every chunk.  The output can't seek, so zipfile writes the size and CRC of
+# each entry after its data (a data descriptor) instead of in its header.
+import csv
+import datetime
+import io
+import json
+import os
+import time
+import zipfile
+import zlib
+
+from peewee import fn, JOIN, SqliteDatabase
+
+from eyesea_db import db, video, analysis, analysis_method, detection, migrate_file
+
+# number of detections read from the database, and sent, at a time
+page_size = 5000
+
+
+# pages of (frameindex, did, x1, y1, x2, y2) of an analysis in frame order,
+# the next page starts after the last (frameindex, did) of the previous one
+def detection_pages(database, aid):
+    size = page_size
+    last = (-1, -1)
+    while True:
+        with database.connection_context():
+            page = list(detection.select(detection.frameindex, detection.did, detection.x1, detection.y1,
+                                         detection.x2, detection.y2).where(
+                detection.aid == aid,
+                (detection.frameindex > last[0]) |
+                ((detection.frameindex == last[0]) & (detection.did > last[1]))).order_by(
+                detection.frameindex, detection.did).limit(size).tuples().bind(database))
+        yield page
+        if len(page) < size:
+            break
+        last = page[-1][:2]
+
+
+# CSV of the detections of a video, one row per box
+# analyses is a list of (aid, method name)
+def csv_rows(database, fps, analyses):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['time', 'x', 'y', 'w', 'h', 'method', 'did'])
+    for aid, ms in analyses:
+        for page in detection_pages(database, aid):
+            for frameindex, did, x1, y1, x2, y2 in page:
+                ts = str(datetime.timedelta(seconds=frameindex/fps))
+                writer.writerow([ts, min(x1, x2), min(y1, y2), abs(x1 - x2), abs(y1 - y2), ms, did])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+# JSON of a video and its analyses like GET /video/<vid>, except that the
+# results of an analysis only list the frames with detections and 'frames'
+# is the number of frames processed
+# analyses is a list of dicts with aid, mid, status, nframes and detections
+def json_chunks(database, v, analyses):
+    head = json.dumps({
+        'id': v['vid'],
+        'filename': v['filename'],
+        'description': v['description'],
+        'fps': v['fps'],
+        'variableFramerate': v['variable_framerate'],
+        'duration': v['duration'],
+        'uri': v['uri'],
+    })
+    yield head[:-1] + ', "analyses": ['
+    for n, a in enumerate(analyses):
+        head = json.dumps({
+            'id': a['aid'],
+            'status': a['status'],
+            'method': a['mid'],
+            'frames': a['nframes'] or 0,
+            'detections': a['detections'],
+        })
+        yield (', ' if n else '') + head[:-1] + ', "results": ['
+        frame = None
+        for page in detection_pages(database, a['aid']):
+            parts = []
+            for frameindex, did, x1, y1, x2, y2 in page:
+                if frameindex != frame:
+                    if frame is not None:
+                        parts.append(']}, ')
+                    parts.append('{{"frameIndex": {}, "detections": ['.format(frameindex))
+                    frame = frameindex
+                else:
+                    parts.append(', ')
+                parts.append('{{"did": {}, "x1": {}, "y1": {}, "x2": {}, "y2": {}}}'.format(did, x1, y1, x2, y2))
+            yield ''.join(parts)
+        yield (']}' if frame is not None else '') + ']}'
+    yield ']}'
+
+
+# finished analyses of all videos of a dataset with their method name and
+# number of detections, as lists of dicts by vid.  Datasets copied from
+# another machine may not have the methods, their name is then None.
+def finished_analyses(database):
+    analyses = {}
+    with database.connection_context():
+        query = analysis.select(analysis.aid, analysis.vid, analysis.mid, analysis.status, analysis.nframes,
+                                analysis_method.description,
+                                fn.COUNT(detection.did).alias('detections')).join(
+            analysis_method, JOIN.LEFT_OUTER, on=(analysis.mid == analysis_method.mid)).switch(
+            analysis).join(detection, JOIN.LEFT_OUTER, on=(detection.aid == analysis.aid)).where(
+            analysis.status == 'FINISHED').group_by(analysis.aid).order_by(
+            analysis.aid).dicts().bind(database)
+        for a in query:
+            analyses.setdefault(a['vid'], []).append(a)
+    return analyses
+
+
+# (name, chunks) of the entries of an export of datasets, a list of
+# (name, path to the database file): a CSV and a JSON file per video under
+# <dataset>/ and manifest.json listing them.  Each dataset is opened when
+# its turn comes, on its own rather than through the router, so the pools of
+# the datasets other clients use are left alone.
+def dataset_entries(datasets):
+    manifest = {'created': datetime.datetime.now().isoformat(), 'datasets': []}
+    for name, path in datasets:
+        migrate_file(path)
+        database = SqliteDatabase(path, pragmas=db.pragmas)
+        with database.connection_context():
+            videos = list(video.select(video).order_by(video.vid).dicts().bind(database))
+        analyses = finished_analyses(database)
+        entry = {'name': name, 'videos': []}
+        for v in videos:
+            a = analyses.get(v['vid'], [])
+            stem = '{}/{}-{}'.format(name, v['vid'], os.path.splitext(os.path.basename(v['filename']))[0])
+            yield stem + '.csv', csv_rows(database, v['fps'], [(i['aid'], i['description']) for i in a])
+            yield stem + '.json', json_chunks(database, v, a)
+            entry['videos'].append({
+                'id': v['vid'],
+                'filename': v['filename'],
+                'description': v['description'],
+                'csv': stem + '.csv',
+                'json': stem + '.json',
+                'analyses': [{'id': i['aid'], 'method': i['mid'], 'methodName': i['description'],
+                              'frames': i['nframes'] or 0, 'detections': i['detections']} for i in a]
+            })
+        database.close()
+        manifest['datasets'].append(entry)
+    yield 'manifest.json', [json.dumps(manifest, indent=1)]
+
+
+# write-only file that keeps what zipfile writes until it is drained
+class _zip_buffer(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        del self.chunks[:]
+        return data
+
+
+# ZIP archive of (name, chunks) entries, as a stream of bytes
+def zip_stream(entries):
+    buf = _zip_buffer()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, chunks in entries:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with z.open(info, 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+                    data = buf.drain()
+                    if data:
+                        yield data
+            yield buf.drain()
+    yield buf.drain()
+
+
+# gzip stream of str or bytes chunks
+def gzip_stream(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = z.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield z.flush()
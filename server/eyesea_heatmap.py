@@ -0,0 +1,263 @@
+# eyesea_heatmap.py
+# Detection density maps for the heatmap routes.
+#
+# Boxes are gathered into one NumPy array and accumulated with a 2D
+# difference array: +1 at the top left corner, -1 right of the box, -1 below
+# it and +1 diagonally past the bottom right corner.  Two cumulative sums
+# then give the number of boxes covering every pixel.
+#
+# The density of each analysis is cached as a grid file keyed by dataset,
+# analysis id, results version and size
+# (<dataset>/<aid>-<version>-<w>x<h>.npz).  A video heatmap is the sum of
+# the grids of its finished analyses, so only new or changed analyses are
+# accumulated again.
+#
+# Heatmap images are rendered without matplotlib: the density is mapped
+# through a precomputed RGBA look-up table and alpha blended onto the
+# thumbnail with PIL.  Rendering runs in a small pool of worker processes
+# (this file run with --worker) so it doesn't block the server.
+import glob
+import json
+import os
+import queue
+import sys
+from collections import Counter
+from subprocess import Popen, PIPE
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+# colors of the heatmap levels, from no detections to the most detections
+heatmap_colors = ['black', '#429321', '#F0ED5E', '#F40E06']
+
+
+# (n, 4) int array of x1, y1, x2, y2 with x1 <= x2 and y1 <= y2
+# rows is an (n, 4) array or an iterable of (x1, y1, x2, y2) tuples
+def box_array(rows):
+    b = np.array(rows if isinstance(rows, np.ndarray) else list(rows), dtype=np.int64).reshape(-1, 4)
+    return np.hstack((np.minimum(b[:, 0:2], b[:, 2:4]), np.maximum(b[:, 0:2], b[:, 2:4])))
+
+
+# number of boxes covering each pixel, as a (height, width) float array
+# boxes cover rows y1 to y2 - 1 and columns x1 to x2 - 1, clipped to the image
+def density(boxes, width, height):
+    d = np.zeros((height + 1, width + 1), dtype=np.int64)
+    if len(boxes):
+        x1 = np.clip(boxes[:, 0], 0, width)
+        y1 = np.clip(boxes[:, 1], 0, height)
+        x2 = np.clip(boxes[:, 2], 0, width)
+        y2 = np.clip(boxes[:, 3], 0, height)
+        np.add.at(d, (y1, x1), 1)
+        np.add.at(d, (y1, x2), -1)
+        np.add.at(d, (y2, x1), -1)
+        np.add.at(d, (y2, x2), 1)
+        d = d.cumsum(axis=0).cumsum(axis=1)
+    return d[:height, :width].astype(np.float64)
+
+
+# block max pooling along one axis, element i goes to block i * n // len
+def _pool(d, n, axis):
+    length = d.shape[axis]
+    shape = list(d.shape)
+    shape[axis] = n
+    s = np.zeros(shape, dtype=d.dtype)
+    if length == 0:
+        return s
+    blocks = np.arange(length) * n // length
+    starts = np.flatnonzero(np.r_[True, np.diff(blocks) > 0])
+    index = [slice(None)] * d.ndim
+    index[axis] = blocks[starts]
+    s[tuple(index)] = np.maximum.reduceat(d, starts, axis=axis)
+    return s
+
+
+# reduce a density map to rows x cols, keeping the maximum of each block
+def downsample(d, rows=100, cols=100):
+    return _pool(_pool(d, rows, 0), cols, 1)
+
+
+# [x, rows - y, value] for every non-zero cell, the format used by the
+# client side visualization
+def pairs(s):
+    y, x = np.nonzero(s)
+    return [[int(i), len(s) - int(j), float(v)] for j, i, v in zip(y, x, s[y, x])]
+
+
+# boxes in old but not in new and boxes in new but not in old
+def box_delta(old, new):
+    old = Counter(map(tuple, old.tolist()))
+    new = Counter(map(tuple, new.tolist()))
+    return list((old - new).elements()), list((new - old).elements())
+
+
+# add (sign=1) or remove (sign=-1) a few boxes from an existing density map
+def apply_boxes(d, boxes, sign=1):
+    height, width = d.shape
+    for x1, y1, x2, y2 in boxes:
+        d[max(y1, 0):min(y2, height), max(x1, 0):min(x2, width)] += sign
+    return d
+
+
+def grid_file(griddir, dataset, aid, version, width, height):
+    return os.path.join(griddir, dataset, '{}-{}-{}x{}.npz'.format(
+        aid, version, width, height))
+
+
+# grid files of all versions and sizes of an analysis
+def grid_files(griddir, dataset, aid):
+    return glob.glob(os.path.join(griddir, dataset, '{}-*.npz'.format(aid)))
+
+
+# parse a file name made by grid_file() back into (version, width, height)
+def grid_key(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    version, size = name.split('-')[-2:]
+    width, height = size.split('x')
+    return int(version), int(width), int(height)
+
+
+# counts are stored in the smallest unsigned type that holds them, compressed
+def save_grid(path, d):
+    peak = d.max() if d.size else 0
+    dtype = np.uint8 if peak < 2**8 else (np.uint16 if peak < 2**16 else np.uint32)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, grid=d.astype(dtype))
+    os.replace(tmp, path)
+
+
+def load_grid(path):
+    with np.load(path) as f:
+        return f['grid'].astype(np.float64)
+
+
+# RGBA look-up table with n levels interpolated between colors, the alpha
+# goes from 0.5 for the lowest level towards 1 for the highest
+def colormap_lut(colors=heatmap_colors, n=8):
+    anchors = np.array([ImageColor.getrgb(c) for c in colors], dtype=np.float64)
+    x = np.linspace(0, 1, n)
+    xp = np.linspace(0, 1, len(colors))
+    rgb = [np.interp(x, xp, anchors[:, k]) for k in range(3)]
+    alpha = np.linspace(0.5, 1, n + 3)[:n] * 255
+    return np.round(np.column_stack(rgb + [alpha])).astype(np.uint8)
+
+
+# vertical bar with the levels of lut and tick labels from 0 to peak
+def colorbar(lut, peak, height, background=(0, 0, 0)):
+    font = ImageFont.load_default()
+    ticks = np.linspace(0, 1, 9) * peak
+    labels = ['{:g}'.format(round(t, 1)) for t in ticks]
+    bar = max(8, height // 20)
+    textw = max(font.getbbox(l)[2] for l in labels) if hasattr(font, 'getbbox') \
+        else max(font.getsize(l)[0] for l in labels)
+    img = Image.new('RGB', (bar + 6 + textw, height), background)
+    draw = ImageDraw.Draw(img)
+    levels = len(lut)
+    for i in range(levels):
+        r, g, b, a = lut[i].tolist()
+        color = tuple(int(round(c * a / 255.0 + k * (1 - a / 255.0))) for c, k in zip((r, g, b), background))
+        top = height - (i + 1) * height // levels
+        bottom = height - i * height // levels
+        draw.rectangle([0, top, bar - 1, bottom - 1], fill=color)
+    for t, label in zip(np.linspace(0, 1, 9), labels):
+        y = int(round((1 - t) * (height - 1)))
+        draw.line([bar, y, bar + 3, y], fill=(255, 255, 255))
+        draw.text((bar + 5, min(max(y - 5, 0), height - 11)), label, fill=(255, 255, 255), font=font)
+    return img
+
+
+# blend the density map d onto the image file, with a colorbar on the right
+def render(d, image, output, lut=None):
+    if lut is None:
+        lut = colormap_lut()
+    peak = d.max() if d.size else 0
+    levels = len(lut)
+    if peak > 0:
+        index = np.minimum((d * (levels / peak)).astype(np.intp), levels - 1)
+    else:
+        index = np.zeros(d.shape, dtype=np.intp)
+    overlay = Image.fromarray(lut[index], 'RGBA')
+    base = Image.open(image).convert('L').convert('RGBA')
+    if overlay.size != base.size:
+        overlay = overlay.resize(base.size, Image.NEAREST)
+    blended = Image.alpha_composite(base, overlay).convert('RGB')
+    bar = colorbar(lut, peak, blended.size[1])
+    out = Image.new('RGB', (blended.size[0] + 5 + bar.size[0], blended.size[1]))
+    out.paste(blended, (0, 0))
+    out.paste(bar, (blended.size[0] + 5, 0))
+    tmp = output + '.tmp'
+    out.save(tmp, 'JPEG', quality=90)
+    os.replace(tmp, output)
+
+
+# sum of the grid files, or zeros of shape (height, width) if there are none
+def sum_grids(grids, shape):
+    d = np.zeros(shape)
+    for path in grids:
+        d += load_grid(path)
+    return d
+
+
+# Pool of rendering processes, each handles one job at a time over its
+# stdin/stdout.  Workers are started on first use and restarted if they die.
+# Under the gevent server the pipes are cooperative, so a request waiting
+# for a worker doesn't block other clients.
+class render_pool():
+    def __init__(self, size=2):
+        self.size = max(1, int(size))
+        self.idle = queue.Queue()
+        for i in range(self.size):
+            self.idle.put(None)
+
+    def _spawn(self):
+        return Popen([sys.executable, os.path.abspath(__file__), '--worker'],
+                     stdin=PIPE, stdout=PIPE, universal_newlines=True)
+
+    # render the sum of the grid files onto image, written to output
+    def render(self, grids, shape, image, output):
+        worker = self.idle.get()
+        try:
+            if worker is None or worker.poll() is not None:
+                worker = self._spawn()
+            worker.stdin.write(json.dumps({'grids': grids, 'shape': list(shape),
+                                           'image': image, 'output': output}) + '\n')
+            worker.stdin.flush()
+            reply = worker.stdout.readline()
+            if not reply:
+                raise RuntimeError('heatmap worker exited with {}'.format(worker.wait()))
+        except Exception:
+            if worker is not None and worker.poll() is None:
+                worker.kill()
+            self.idle.put(None)
+            raise
+        self.idle.put(worker)
+        reply = json.loads(reply)
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return output
+
+    def close(self):
+        for i in range(self.size):
+            worker = self.idle.get()
+            if worker is not None and worker.poll() is None:
+                worker.stdin.close()
+                worker.wait()
+
+
+def worker():
+    lut = colormap_lut()
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            render(sum_grids(job['grids'], job['shape']), job['image'], job['output'], lut)
+            reply = {'output': job['output']}
+        except Exception as e:
+            reply = {'error': '{}: {}'.format(e.__class__.__name__, e)}
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    if '--worker' in sys.argv:
+        worker()
@@ -0,0 +1,191 @@
+# eyesea_jobs.py
+# Bounded, prioritized scheduler for analysis subprocesses.
+#
+# Analyses wait in a priority queue with status QUEUED and are only started
+# (with Popen) when one of max_workers slots is free.  Higher priority runs
+# first, equal priorities run in the order they were submitted.
+#
+# The slots are shared by all datasets, so jobs are known by a key
+# (dataset path, aid) and their status is written to their own dataset.
+#
+# An analysis may be split in shards, frame ranges processed by processes of
+# their own.  It takes a slot per shard and its processes are started and
+# stopped together.
+import heapq
+import itertools
+import os
+import sys
+import time
+from subprocess import Popen
+
+from eyesea_db import db, analysis
+
+
+# remove the output and stderr files of a task once it has been ingested
+def cleanup_task(task):
+    for output in task['outputs']:
+        try:
+            os.remove(output)
+        except OSError:
+            pass
+    try:
+        task['error'].close()
+        os.remove(task['error'].name)
+    except OSError:
+        pass
+
+
+# The processes of the shards of an analysis, used like one Popen.  poll()
+# is None until they have all exited; when one fails the others are
+# terminated and its code is the return code of the group.
+class shard_group():
+    def __init__(self, processes):
+        self.processes = processes
+        self.pids = [p.pid for p in processes]
+        self.returncode = None
+
+    def _returncode(self, codes):
+        failed = [c for c in codes if c]
+        if failed:
+            return failed[0]
+        return None if None in codes else 0
+
+    def poll(self):
+        if self.returncode is None:
+            codes = [p.poll() for p in self.processes]
+            if None in codes and any(codes):
+                self.terminate()
+                self.wait()
+            self.returncode = self._returncode(codes)
+        return self.returncode
+
+    def terminate(self):
+        for p in self.processes:
+            if p.poll() is None:
+                p.terminate()
+
+    def wait(self):
+        codes = [p.wait() for p in self.processes]
+        if self.returncode is None:
+            self.returncode = self._returncode(codes)
+        return self.returncode
+
+
+# slots taken by a job or task
+def slots(job):
+    return len(job.get('shards') or job.get('outputs') or [None])
+
+
+class scheduler():
+    def __init__(self, max_workers=2):
+        self.max_workers = max(1, int(max_workers))
+        # key -> running task {'p', 'outputs', 'error', 'mid', 'started'}
+        # this is what the server calls its tasklist
+        self.running = {}
+        # key -> heap entry [-priority, seq, key, job]
+        # an entry whose job is None was cancelled or reprioritized and is
+        # skipped when it reaches the top of the heap
+        self.queued = {}
+        self.heap = []
+        self.seq = itertools.count()
+
+    # key is (dataset path, aid), job is a dict with the command line
+    # ('args'), environment ('env'), result file ('output'), stderr file
+    # ('error') and method id ('mid').  A job split in shards also has
+    # 'shards', a list of {'args', 'output'} run instead of args and output.
+    def submit(self, key, job, priority=0):
+        entry = [-int(priority), next(self.seq), key, job]
+        self.queued[key] = entry
+        heapq.heappush(self.heap, entry)
+        return self.start_queued()
+
+    # slots in use
+    def used(self):
+        return sum(slots(task) for task in self.running.values())
+
+    # start queued jobs until all slots are in use; a job with more shards
+    # than free slots waits for them, the jobs after it too
+    def start_queued(self):
+        started = []
+        while self.heap:
+            priority, seq, key, job = self.heap[0]
+            if job is None:
+                heapq.heappop(self.heap)
+                continue
+            if self.used() and self.used() + slots(job) > self.max_workers:
+                break
+            heapq.heappop(self.heap)
+            del self.queued[key]
+            if self._start(key, job):
+                started.append(key)
+        return started
+
+    # a status that can't be written is logged, the scheduler goes on
+    def _set_status(self, key, status):
+        dataset, aid = key
+        try:
+            with db.using(dataset):
+                analysis.update({'status': status}).where(analysis.aid == aid).execute()
+        except Exception as e:
+            print('Unable to set status of analysis {} to {}: {}'.format(aid, status, e),
+                  file=sys.stderr)
+
+    def _start(self, key, job):
+        stderr = None
+        processes = []
+        shards = job.get('shards') or [{'args': job['args'], 'output': job['output']}]
+        try:
+            # shards share the stderr file
+            stderr = open(job['error'], 'w+')
+            for shard in shards:
+                processes.append(Popen(shard['args'], env=job['env'], stderr=stderr))
+        except Exception as e:
+            print('Unable to start analysis {}: {}'.format(key[1], e), file=sys.stderr)
+            for p in processes:
+                p.terminate()
+                p.wait()
+            if stderr:
+                stderr.close()
+            self._set_status(key, 'FAILED')
+            return False
+        p = processes[0] if len(processes) == 1 else shard_group(processes)
+        self.running[key] = {'p': p, 'outputs': [shard['output'] for shard in shards], 'error': stderr,
+                             'mid': job['mid'], 'started': time.time()}
+        self._set_status(key, 'PROCESSING')
+        return True
+
+    # release the slot of a task whose process has exited
+    def finish(self, key):
+        task = self.running.pop(key, None)
+        self.start_queued()
+        return task
+
+    def cancel(self, key):
+        if key in self.queued:
+            self.queued.pop(key)[-1] = None
+        elif key in self.running:
+            task = self.running.pop(key)
+            task['p'].terminate()
+            task['p'].wait()
+            cleanup_task(task)
+        else:
+            return False
+        self._set_status(key, 'CANCELLED')
+        self.start_queued()
+        return True
+
+    def reprioritize(self, key, priority):
+        if key not in self.queued:
+            return False
+        entry = self.queued[key]
+        job, entry[-1] = entry[-1], None
+        # the job goes to the back of its new priority level
+        entry = [-int(priority), next(self.seq), key, job]
+        self.queued[key] = entry
+        heapq.heappush(self.heap, entry)
+        return True
+
+    # queued jobs in the order they will be started
+    def queue(self):
+        return [{'dataset': e[2][0], 'id': e[2][1], 'method': e[3]['mid'], 'priority': -e[0], 'position': i}
+                for i, e in enumerate(sorted(self.queued.values(), key=lambda e: e[:2]))]
@@ -0,0 +1,186 @@
+# eyesea_metrics.py
+# Counters, gauges and histograms of the server, served by GET /metrics in
+# the Prometheus text exposition format.
+#
+# Everything is kept in memory by the server process.  Metrics are only
+# changed from greenlets and an update never yields, so they need no lock.
+# Values that are cheaper to read when asked for (running analyses, queue
+# depth, CPU and memory of processes) are gauges with a collect function
+# called on every scrape.
+import os
+import time
+from contextlib import contextmanager
+
+import bottle
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# all metrics, in the order they are exposed
+registry = []
+
+# seconds, from a fast query to a long analysis
+default_buckets = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)) + '}'
+
+
+def _value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class counter():
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[l]) for l in self.labels)
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + n
+
+    # (name, label names, label values, value)
+    def samples(self):
+        for key in sorted(self.values):
+            yield self.name, self.labels, key, self.values[key]
+
+
+# collect, if given, returns {label values: value} and replaces what was set
+class gauge(counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        counter.__init__(self, name, help, labels)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.collect:
+            self.values = self.collect()
+        return counter.samples(self)
+
+
+class histogram(counter):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        counter.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += 1
+        entry[2] += value
+
+    # time the body of a with statement
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for key in sorted(self.values):
+            counts, count, total = self.values[key]
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self.name + '_bucket', names, key + (_value(bound),), cumulative
+            yield self.name + '_count', self.labels, key, count
+            yield self.name + '_sum', self.labels, key, total
+
+
+# all metrics as text
+def exposition():
+    lines = []
+    for m in registry:
+        lines.append('# HELP {} {}'.format(m.name, m.help))
+        lines.append('# TYPE {} {}'.format(m.name, m.kind))
+        for name, names, values, value in m.samples():
+            lines.append('{}{} {}'.format(name, _labels(names, values), _value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+# (CPU seconds, resident bytes) of a process, None if it can't be read.
+# Uses psutil if it is installed, otherwise /proc on Linux.
+def process_usage(pid):
+    try:
+        if psutil:
+            p = psutil.Process(pid)
+            cpu = p.cpu_times()
+            return cpu.user + cpu.system, p.memory_info().rss
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the command name may contain spaces, the fields after it don't
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        return (int(fields[11]) + int(fields[12])) / ticks, int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return None
+
+
+requests = histogram('eyesea_request_seconds', 'Time spent in route handlers.',
+                     ('method', 'route', 'status'))
+queries = histogram('eyesea_db_query_seconds', 'Time to execute database statements.', ('statement',))
+results_parse = histogram('eyesea_results_parse_seconds', 'Time to read and parse the results file of an analysis.')
+jobs = counter('eyesea_analyses_total', 'Analyses that ended, by method and status.', ('method', 'status'))
+job_seconds = histogram('eyesea_analysis_seconds', 'Run time of analyses, by method and status.',
+                        ('method', 'status'))
+cache = counter('eyesea_cache_requests_total', 'Lookups of cached files.', ('cache', 'result'))
+
+
+def cache_lookup(name, hit):
+    cache.inc(cache=name, result='hit' if hit else 'miss')
+
+
+# Bottle plugin timing every route.  The route label is the rule, not the
+# URL, so there is one series per route.  Handlers that return a generator
+# are timed until they return it, not until it has been sent.
+class timing_plugin():
+    name = 'metrics'
+    api = 2
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            status = 500
+            try:
+                body = callback(*args, **kwargs)
+                status = bottle.response.status_code
+                return body
+            except bottle.HTTPResponse as r:
+                status = r.status_code
+                raise
+            finally:
+                requests.observe(time.time() - start, method=route.method, route=route.rule, status=status)
+        return wrapper
@@ -0,0 +1,115 @@
+# eyesea_profiling.py
+# Opt-in profiling of single requests.
+#
+# With "profiling": true in the settings, a request sent with an X-Profile
+# header or a profile query parameter runs its handler under cProfile.
+# "memory" as the value also traces allocations with tracemalloc.  The
+# profile is saved in the profile directory as <name>.prof (for pstats or
+# snakeviz) with a text summary in <name>.txt, and the functions with the
+# most cumulative time are returned in the X-Profile header:
+#
+#   curl -D - -H 'X-Profile: 1' http://localhost:8080/video/1/heatmap
+#
+# Greenlets share the thread of the server, so only one request is profiled
+# at a time; others are answered with X-Profile: busy.  Handlers that return
+# a generator are profiled until they return it, not until it is sent.
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+import tracemalloc
+
+import bottle
+
+# number of allocation sites in the summary
+memory_top = 20
+
+
+# value of the X-Profile header or profile parameter, None if not asked for
+def requested():
+    return bottle.request.get_header('X-Profile') or bottle.request.query.get('profile') or None
+
+
+# 'file:line(function) cumulative seconds' of the top functions of stats
+def top_functions(stats, top):
+    functions = sorted(stats.stats.items(), key=lambda s: s[1][3], reverse=True)[:top]
+    return ['{}:{}({}) {:.4f}'.format(os.path.basename(f), line, name, cumulative)
+            for (f, line, name), (calls, ncalls, total, cumulative, callers) in functions]
+
+
+class profiling_plugin():
+    name = 'profiling'
+    api = 2
+
+    def __init__(self, directory, top=10):
+        self.directory = directory
+        self.top = top
+        self.active = False
+        os.makedirs(directory, exist_ok=True)
+
+    # base name of the files of a request
+    def _name(self, route):
+        rule = re.sub(r'[^A-Za-z0-9]+', '_', route.rule).strip('_') or 'root'
+        now = time.time()
+        return '{}.{:03d}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+                                        int(now * 1000) % 1000, route.method.lower(), rule)
+
+    def _save(self, profiler, route, memory, elapsed):
+        name = self._name(route)
+        path = os.path.join(self.directory, name)
+        profiler.dump_stats(path + '.prof')
+        summary = io.StringIO()
+        summary.write('{} {} {:.4f}s\n\n'.format(bottle.request.method, bottle.request.path, elapsed))
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.sort_stats('cumulative').print_stats(50)
+        if memory is not None:
+            summary.write('Allocations by line, top {}\n'.format(memory_top))
+            for stat in memory.statistics('lineno')[:memory_top]:
+                summary.write('{}\n'.format(stat))
+        with open(path + '.txt', 'w') as f:
+            f.write(summary.getvalue())
+        return name, top_functions(stats, self.top)
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            mode = requested()
+            if not mode:
+                return callback(*args, **kwargs)
+            if self.active:
+                bottle.response.set_header('X-Profile', 'busy')
+                return callback(*args, **kwargs)
+
+            self.active = True
+            memory = mode == 'memory' and not tracemalloc.is_tracing()
+            if memory:
+                tracemalloc.start()
+            profiler = cProfile.Profile()
+            start = time.time()
+            target = bottle.response
+            try:
+                profiler.enable()
+                try:
+                    body = callback(*args, **kwargs)
+                finally:
+                    profiler.disable()
+                # static_file() and the like return a response of their own
+                if isinstance(body, bottle.HTTPResponse):
+                    target = body
+                return body
+            except bottle.HTTPResponse as r:
+                target = r
+                raise
+            finally:
+                snapshot = tracemalloc.take_snapshot() if memory else None
+                if memory:
+                    tracemalloc.stop()
+                self.active = False
+                try:
+                    name, functions = self._save(profiler, route, snapshot, time.time() - start)
+                    target.set_header('X-Profile', '; '.join(functions))
+                    target.set_header('X-Profile-File', name)
+                except Exception as e:
+                    print('Unable to save profile: {}'.format(e))
+        return wrapper
@@ -6,6 +6,7 @@ from __future__ import division  # divide array by scalar, don't floor result
 
 import cgi
 import gevent.monkey; gevent.monkey.patch_all()
+import gevent
 import bottle
 import json
 import os
@@ -14,26 +15,23 @@ import subprocess
 import base64
 import time
 import hashlib
+import glob
 import sys
-import zipfile
-import math
 import traceback
 
 import numpy as np
-from numpy import inf
-
-import matplotlib
-# the following line is needed for running on Mac in vituralenv or conda
-#matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from PIL import Image
-from subprocess import check_output, Popen, PIPE, CalledProcessError
+from subprocess import check_output, PIPE, CalledProcessError
 from bottle import request, response, post, get, put, delete, hook, route, static_file
 from eyesea_db import *
-from peewee import fn
+from eyesea_jobs import scheduler, cleanup_task
+import eyesea_heatmap as heatmap
+import eyesea_export as export
+import eyesea_datasets as datasets
+import eyesea_metrics as metrics
+import eyesea_profiling as profiling
+from peewee import fn, JOIN, SqliteDatabase
 
 import ffmpeg
 
@@ -46,7 +44,15 @@ settings = json.loads(open('eyesea_settings.json').read())
 
 # path for storing database files
 abs_db_path = os.path.abspath(os.path.expandvars(settings['database_storage']))
+# the dataset of requests that don't name one, see br()
+db.max_datasets = settings.get('max_datasets', 8)
+db.max_connections = settings.get('max_connections', 20)
+# pragmas of the settings replace the defaults in eyesea_db.py
+db.pragmas = list(dict(db.pragmas, **settings.get('sqlite_pragmas', {})).items())
 db.init(os.path.join(abs_db_path, settings['database']))
+migrate_database()
+# so a request naming the default dataset doesn't migrate it again
+migrated.add(db.database)
 
 
 cache = os.path.expandvars(settings['cache'])
@@ -57,6 +63,11 @@ videostore = os.path.expandvars(settings['video_storage'])
 if not os.path.isdir(videostore):
     os.makedirs(videostore)
 
+# per-analysis heatmap density grids, see eyesea_heatmap.py
+gridstore = os.path.join(cache, 'grids')
+# processes rendering heatmap images
+renderer = heatmap.render_pool(settings.get('render_workers', 2))
+
 tmp = os.path.expandvars(settings['temporary_storage'])
 if not os.path.isdir(tmp):
     os.makedirs(tmp)
@@ -69,7 +80,74 @@ vcodec = settings['ffmpeg_vcodec']
 
 # TODO: get this from settings file
 abs_algorithm_path = os.path.abspath(os.path.join(os.path.dirname(os.getcwd()),'algorithms'))
-tasklist = {}
+# analyses are run by the scheduler, at most max_workers at a time;
+# tasklist is its view of the running ones
+jobs = scheduler(settings.get('max_workers', 2))
+tasklist = jobs.running
+
+
+# The queue is only kept in memory and the outputs in tmp were removed above,
+# so analyses left QUEUED or PROCESSING by the previous run of the server
+# would never end; they are marked FAILED in every dataset.  The files are
+# opened on their own, not through the router and its pools.
+def fail_interrupted_analyses():
+    for f in sorted(os.listdir(abs_db_path)):
+        if os.path.splitext(f)[1] != '.db':
+            continue
+        database = SqliteDatabase(os.path.join(abs_db_path, f))
+        try:
+            with database.connection_context():
+                n = analysis.update({'status': 'FAILED'}).where(
+                    analysis.status.in_(['QUEUED', 'PROCESSING'])).bind(database).execute()
+            if n:
+                print('{}: {} interrupted analyses marked FAILED'.format(f, n))
+        except Exception as e:
+            print('Unable to check the analyses of {}: {}'.format(f, e))
+
+
+fail_interrupted_analyses()
+# an analysis by one of shard_methods is split in up to analysis_shards frame
+# ranges run in parallel; shard_methods gives the warm-up frames of a method
+analysis_shards = settings.get('analysis_shards', 1)
+shard_methods = settings.get('shard_methods', {})
+# summaries of day databases for /datasets/statistics
+summaries = datasets.summary_cache(settings.get('query_workers', 4))
+
+
+def running_by_method():
+    running = {}
+    for task in tasklist.values():
+        key = (str(task['mid']),)
+        running[key] = running.get(key, 0) + 1
+    return running
+
+
+# CPU seconds or resident bytes (index 0 or 1 of process_usage()) of the
+# server and of each running analysis process
+def usage_by_process(index):
+    usage = {('server', '', ''): metrics.process_usage(os.getpid())}
+    for (dataset, aid), task in tasklist.items():
+        # the processes of all the shards of an analysis
+        shards = [metrics.process_usage(pid) for pid in getattr(task['p'], 'pids', [task['p'].pid])]
+        if all(shards):
+            usage[('analysis', dataset_name(dataset), str(aid))] = [sum(u) for u in zip(*shards)]
+    return {key: u[index] for key, u in usage.items() if u}
+
+
+metrics.gauge('eyesea_analyses_running', 'Analyses being processed, by method.', ('method',),
+              running_by_method)
+metrics.gauge('eyesea_analyses_queued', 'Analyses waiting for a free slot.',
+              collect=lambda: {(): len(jobs.queued)})
+metrics.gauge('eyesea_process_cpu_seconds', 'CPU time of the server and of running analyses.',
+              ('process', 'dataset', 'analysis'), lambda: usage_by_process(0))
+metrics.gauge('eyesea_process_resident_bytes', 'Resident memory of the server and of running analyses.',
+              ('process', 'dataset', 'analysis'), lambda: usage_by_process(1))
+bottle.install(metrics.timing_plugin())
+# opt-in profiling of single requests, see eyesea_profiling.py
+if settings.get('profiling', False):
+    bottle.install(profiling.profiling_plugin(
+        os.path.expandvars(settings.get('profile_storage', os.path.join('..', 'storage', 'profiles'))),
+        settings.get('profile_top', 10)))
 
 # scan the algorithms dir to find available algorithms
 def scanmethods():
@@ -103,7 +181,7 @@ scanmethods()
 
 def format_video(vid, analyses=None):
     if not analyses:
-        analyses = [get_or_update_analysis(i) for i in analysis.select(
+        analyses = [format_analysis(i) for i in analysis.select(
             analysis).where(analysis.vid == vid['vid']).dicts()]
     return {
         'id': vid['vid'],
@@ -117,45 +195,123 @@ def format_video(vid, analyses=None):
     }
 
 
-def get_or_update_analysis(a):
-    if a['aid'] in tasklist:
-        task = tasklist[a['aid']]
-        p = task['p'].poll()
-        if p is not None:
-            data = {'status': 'FINISHED', 'results': ''}
-            # import pdb; pdb.set_trace()
-            if p:
-                data['status'] = 'FAILED'
-                task['error'].flush()
-                os.fsync(task['error'].fileno())
-                task['error'].seek(0)
-                # data['results'] = task['error'].read()
-                print(task['error'].read())
-            else:
-                with open(task['output']) as f:
-                    results = json.loads(f.read())['frames']
-                    data['results'] = json.dumps(
-                        results, separators=(',', ':'))
-            analysis.update(data).where(analysis.aid == a['aid']).execute()
-            a = analysis.select().where(analysis.aid == a['aid']).dicts().get()
-            del tasklist[a['aid']]
-            # cleanup time
+# format_video() for a list of videos, loading all of their analyses with
+# one query instead of one per video.  With summary the analyses only have
+# their status and detection count, not the detections themselves.
+def format_videos(videos, summary=False):
+    analyses = {v['vid']: [] for v in videos}
+    vids = list(analyses.keys())
+    for i in range(0, len(vids), batch_size):
+        if summary:
+            query = analysis.select(analysis.aid, analysis.vid, analysis.mid, analysis.status,
+                                    analysis.nframes, fn.COUNT(detection.did).alias('detections')).join(
+                detection, JOIN.LEFT_OUTER, on=(detection.aid == analysis.aid)).where(
+                analysis.vid.in_(vids[i:i + batch_size])).group_by(analysis.aid).order_by(
+                analysis.aid).dicts()
+            for a in query:
+                analyses[a['vid']].append(format_analysis_summary(a))
+        else:
+            query = list(analysis.select(analysis).where(
+                analysis.vid.in_(vids[i:i + batch_size])).order_by(analysis.aid).dicts())
+            results = load_results_many({a['aid']: a['nframes'] for a in query
+                                         if a['status'] == 'FINISHED'})
+            for a in query:
+                analyses[a['vid']].append(format_analysis(a, results.get(a['aid'], [])))
+    return [format_video(v, analyses[v['vid']]) for v in videos]
+
+
+# (frames, nframes) of the result files of an analysis, one per shard in
+# frame order; the last shard ends at the last frame
+def read_results(outputs):
+    frames = []
+    nframes = None
+    for output in outputs:
+        with open(output) as f:
+            results = json.loads(f.read())
+        frames.extend(results['frames'])
+        nframes = results.get('nframes')
+    return frames, nframes
+
+
+# store the results of a finished analysis process in the database
+def ingest_analysis(aid, task, returncode):
+    data = {'status': 'FINISHED', 'results': ''}
+    if returncode:
+        data['status'] = 'FAILED'
+        task['error'].flush()
+        os.fsync(task['error'].fileno())
+        task['error'].seek(0)
+        # data['results'] = task['error'].read()
+        print(task['error'].read())
+    else:
+        with metrics.results_parse.time():
+            frames, nframes = read_results(task['outputs'])
+        # nframes is missing from files written by older versions of the API,
+        # those list every frame
+        store_results(aid, frames, nframes)
+    analysis.update(data).where(analysis.aid == aid).execute()
+    update_statistics(analysis.select(analysis.vid).where(analysis.aid == aid).scalar())
+
+
+# Runs in the background for the life of the server, so results are ingested
+# as soon as a process exits instead of whenever a client happens to ask.
+def reap_analyses(interval):
+    while True:
+        finished = [(key, task) for key, task in list(tasklist.items())
+                    if task['p'].poll() is not None]
+        for key, task in finished:
             try:
-                os.remove(task['output'])
-            except OSError:
-                pass
+                status = reap_analysis(key, task)
+            except Exception as e:
+                if dataset_locked(e):
+                    # the task stays in the tasklist and is ingested again on
+                    # the next pass
+                    print('Analysis {} not ingested yet: {}'.format(key[1], e))
+                    continue
+                print(exception_to_string(e))
+                status = 'FAILED'
             try:
-                task['error'].close()
-                os.remove(task['error'].name)
-            except OSError:
-                pass
-
-    try:
-        results = json.loads(a['results'] if a['results'] else '{}')
-    except Exception as e:
-        print(exception_to_string(e))
-        print(a['results'])
-        results = []
+                cleanup_task(task)
+                metrics.jobs.inc(method=task['mid'], status=status)
+                metrics.job_seconds.observe(time.time() - task['started'], method=task['mid'], status=status)
+            except Exception as e:
+                print(exception_to_string(e))
+            finally:
+                # frees the slot for the next queued analysis
+                jobs.finish(key)
+        gevent.sleep(interval)
+
+
+# another connection is writing to the dataset, trying again later may work
+def dataset_locked(e):
+    return isinstance(e, OperationalError) and 'locked' in str(e)
+
+
+# Ingest a finished task and return the status its analysis ends with.
+# Nothing is stored when the dataset is locked, the error is raised then.
+def reap_analysis(key, task):
+    dataset, aid = key
+    status = 'FAILED' if task['p'].returncode else 'FINISHED'
+    with db.using(dataset):
+        try:
+            # detections, status and statistics in one transaction
+            with db.atomic():
+                ingest_analysis(aid, task, task['p'].returncode)
+                vid = analysis.select(analysis.vid).where(analysis.aid == aid).scalar()
+        except Exception as e:
+            if dataset_locked(e):
+                raise
+            print(exception_to_string(e))
+            analysis.update({'status': 'FAILED'}).where(analysis.aid == aid).execute()
+            return 'FAILED'
+    if status == 'FINISHED':
+        gevent.spawn(prerender_heatmap, vid, dataset)
+    return status
+
+
+def format_analysis(a, results=None):
+    if results is None:
+        results = load_results(a['aid'], a['nframes']) if a['status'] == 'FINISHED' else []
 
     return {
         'id': a['aid'],
@@ -170,6 +326,136 @@ def get_or_update_analysis(a):
     }
 
 
+# a has the analysis columns and a count of its detections
+def format_analysis_summary(a):
+    return {
+        'id': a['aid'],
+        'status': a['status'],
+        'method': a['mid'],
+        'frames': a['nframes'] or 0,
+        'detections': a['detections']
+    }
+
+
+# name of a database file, by default the one of the current request, used
+# to keep cache entries of datasets apart
+def dataset_name(path=None):
+    return os.path.splitext(os.path.basename(path or db.database))[0]
+
+
+def analysis_boxes(aid):
+    return heatmap.box_array(load_columns(aid)['boxes'])
+
+
+# aid and results version of the finished analyses of a video
+def heatmap_analyses(vid):
+    return analysis.select(analysis.aid, analysis.version).where(
+        analysis.vid == vid, analysis.status == 'FINISHED').order_by(analysis.aid).dicts()
+
+
+# changes whenever a finished analysis is added or its detections are edited
+def heatmap_key(analyses, w, h):
+    key = hashlib.sha1('{}:{}x{}'.format(dataset_name(), w, h).encode())
+    for a in analyses:
+        key.update(' {}-{}'.format(a['aid'], a['version']).encode())
+    return key.hexdigest()[:16]
+
+
+# cached density grid files of the analyses, only analyses without a grid
+# for their current version are accumulated from the detection table
+def heatmap_grids(analyses, w, h):
+    grids = []
+    for a in analyses:
+        path = heatmap.grid_file(gridstore, dataset_name(), a['aid'], a['version'], w, h)
+        hit = os.path.isfile(path)
+        metrics.cache_lookup('heatmap_grid', hit)
+        if not hit:
+            heatmap.save_grid(path, heatmap.density(analysis_boxes(a['aid']), w, h))
+        grids.append(path)
+    return grids
+
+
+# Bring the cached grids of an analysis from old_version up to its current
+# version by removing and adding only the boxes that changed.  Grids of
+# other versions are stale and removed.
+def update_heatmap_grids(aid, old_version, removed, added):
+    files = heatmap.grid_files(gridstore, dataset_name(), aid)
+    if not files:
+        return
+    version = analysis.select(analysis.version).where(analysis.aid == aid).scalar()
+    for path in files:
+        grid_version, w, h = heatmap.grid_key(path)
+        if grid_version == old_version:
+            d = heatmap.load_grid(path)
+            heatmap.apply_boxes(d, removed, -1)
+            heatmap.apply_boxes(d, added, 1)
+            heatmap.save_grid(heatmap.grid_file(gridstore, dataset_name(), aid, version, w, h), d)
+        if grid_version != version:
+            os.remove(path)
+
+
+# boxes of the detections in the before or after column of edits
+def edit_boxes(edits, column):
+    return heatmap.box_array((b['x1'], b['y1'], b['x2'], b['y2'])
+                             for b in (json.loads(e[column]) for e in edits if e[column]))
+
+
+# Fold the edit log of the analyses of a video, or of all videos, into the
+# heatmap grids and statistics, and return the vids that had edits.  Runs
+# in the background (compact_datasets) and before either is read.
+def compact_edits(vid=None):
+    edits = pending_edits(vid)
+    if not edits:
+        return set()
+    for aid, log in edits.items():
+        update_heatmap_grids(aid, log[0]['version'], edit_boxes(log, 'before'), edit_boxes(log, 'after'))
+    with db.atomic():
+        for aid, log in edits.items():
+            clear_edits(aid, log[-1]['eid'])
+        vids = {v for v, in analysis.select(analysis.vid).where(analysis.aid.in_(list(edits))).tuples()}
+        for v in vids:
+            update_statistics(v)
+    return vids
+
+
+# datasets that may have edits to compact
+edited = set()
+
+
+def compact_datasets(interval):
+    while True:
+        for dataset in list(edited):
+            edited.discard(dataset)
+            try:
+                with db.using(dataset):
+                    vids = compact_edits()
+                for vid in vids:
+                    prerender_heatmap(vid, dataset)
+            except Exception as e:
+                print(exception_to_string(e))
+        gevent.sleep(interval)
+
+
+# name of a cached heatmap of a video of the current dataset
+def heatmap_file(filename, key, ext):
+    return '{}_heatmap_{}_{}.{}'.format(filename, dataset_name(), key, ext)
+
+
+# glob of all versions of heatmap_file(), keys are 16 characters long
+def heatmap_pattern(filename, ext):
+    return '{}_heatmap_{}_{}.{}'.format(glob.escape(filename), glob.escape(dataset_name()), '?' * 16, ext)
+
+
+# remove cached outputs matching pattern except the current one
+def remove_stale(pattern, current):
+    for f in glob.glob(os.path.join(cache, pattern)):
+        if os.path.basename(f) != current:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+
 # Not everything is friendly with a file:// path.
 drive_letter = re.compile('/[a-zA-Z]:')
 
@@ -199,7 +485,20 @@ def get_video_path_parts(vid):
     return (pathname, filename, root)
 
 
-def queue_analysis(index, vid, method, procargs=None):
+# [(start, end)] frame ranges of the shards of an analysis of vid by the
+# method named name, end None for the last one.  One range unless the method
+# is in shard_methods; a shard has at least as many frames as its warm-up.
+def shard_ranges(vid, name):
+    warmup = shard_methods.get(name)
+    frames = int(round((vid['duration'] or 0) * (vid['fps'] or 0)))
+    if warmup is None or not frames:
+        return [(0, None)]
+    k = max(1, min(analysis_shards, jobs.max_workers, frames // max(1, warmup)))
+    bounds = [frames * i // k for i in range(k)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def queue_analysis(index, vid, method, procargs=None, priority=0):
     # Will throw an error if vid is not-existent, this is on purpose because 
     # all future analyses would die with the same error so we cut out early.
     vid = video.select(video).where(video.vid == vid).dicts().get()
@@ -231,24 +530,33 @@ def queue_analysis(index, vid, method, procargs=None):
                                   else abs_algorithm_path, f=base_args['script'])
         print('******* script = ' + script)
         input = '{p}/{f}'.format(p=root, f=pathname)
-        # Prevent stepping on toes if for some reason the user selects the same algorithm twice for a video or one
-        # in use by another video whose source hashes to the same as this video.
-        slug = '{p}/{f}-{v}-{i}-{m}'.format(p=tmp, f=filename,
-                                            v=vid['vid'], i=index, m=method['mid'])
-        output = slug + '.json'
-        args = ['python', script, input, output, '--verbose']
-        args.extend(np.array([[k, v] for k, v in procargs.items()]).flatten())
         aid = analysis.select().where(analysis.aid == analysis.insert(
             {'mid': method['mid'], 'vid': vid['vid'], 'status': 'QUEUED', 'parameters': json.dumps(procargs), 'results': ''}).execute()).dicts().get()
-        stderr = open(slug + '.err', 'w+')
+        # Prevent stepping on toes if for some reason the user selects the same algorithm twice for a video or one
+        # in use by another video whose source hashes to the same as this video; analyses run at the same time,
+        # so the aid keeps their files apart.
+        slug = '{p}/{f}-{d}-{v}-{i}-{m}-{a}'.format(p=tmp, f=filename, d=dataset_name(),
+                                                    v=vid['vid'], i=index, m=method['mid'], a=aid['aid'])
+        output = slug + '.json'
+        params = list(np.array([[k, v] for k, v in procargs.items()]).flatten())
+        args = ['python', script, input, output, '--verbose'] + params
+        shards = []
+        ranges = shard_ranges(vid, base_args.get('name'))
+        if len(ranges) > 1:
+            for i, (start, end) in enumerate(ranges):
+                shard_output = '{}-s{}.json'.format(slug, i)
+                shard_args = ['python', script, input, shard_output, '--verbose', '--start', str(start),
+                              '--warmup', str(shard_methods[base_args.get('name')])]
+                if end is not None:
+                    shard_args += ['--end', str(end)]
+                shards.append({'args': shard_args + params, 'output': shard_output})
         # Python on Windows hates u'' strings apparently; This should go away with a switch to Python 3.x
         local_env = {str(key): str(value)
                      for key, value in os.environ.items()}
         local_env['PATH'] += os.pathsep + (method['path'] if method['path'] else abs_algorithm_path)
-        tasklist[aid['aid']] = {'p': Popen(
-            args, env=local_env, stderr=stderr), 'output': output, 'error': stderr}
-        analysis.update({'status': 'PROCESSING'}).where(
-            analysis.aid == aid['aid']).execute()
+        # stays QUEUED until the scheduler has a free slot for it
+        jobs.submit((db.database, aid['aid']), {'args': args, 'env': local_env, 'output': output,
+                                 'error': slug + '.err', 'mid': method['mid'], 'shards': shards}, priority)
         return analysis.select().where(analysis.aid == aid['aid']).dicts().get()
     except Exception as e:
         print(exception_to_string(e))
@@ -263,6 +571,12 @@ def exception_to_string(excp):
    pretty = traceback.format_list(stack)
    return ''.join(pretty) + '\n  {} {}'.format(excp.__class__,excp)
 
+
+reaper = gevent.spawn(reap_analyses, settings.get('reap_interval', 1.0))
+# edits left from before a restart are compacted too
+edited.add(db.database)
+compactor = gevent.spawn(compact_datasets, settings.get('compact_interval', 5.0))
+
 # Should be similar to what subprocess.checkout_output does, except it handles stderr
 def check_output_with_error(*pargs, **args):
     if 'stdout' in args or 'stderr' in args:
@@ -336,15 +650,52 @@ def fr():
         return lambda x: 'Unknown request header: ' + hdr
 
 
+# path of a dataset in the database storage, None if there is no such file
+def dataset_path(name):
+    path = os.path.join(abs_db_path, name + '.db')
+    if os.path.basename(name) != name or not os.path.isfile(path):
+        return None
+    return path
+
+
+dataset_prefix = re.compile('^/dataset/([^/]+)(/.*)$')
+
+# Requests name their dataset with a /dataset/<name> prefix on any route
+# (e.g. /dataset/stereovision-2020_05_05/video) or an X-Dataset header,
+# otherwise the dataset of the settings file is used.  The connection is
+# taken from the pool of the dataset and returned to it after the request.
 @hook('before_request')
 def br():
+    name = request.get_header('X-Dataset')
+    m = dataset_prefix.match(request.environ['PATH_INFO'])
+    if m:
+        name = m.group(1)
+        request.environ['PATH_INFO'] = m.group(2)
+    path = None
+    if name:
+        path = dataset_path(name)
+        if not path:
+            db.use(None)
+            # raised before the route, so after_request doesn't add the headers
+            resp = bottle.HTTPResponse(json.dumps({'error': 'Unknown dataset {}.'.format(name)}), 404)
+            allow_cross_origin(resp)
+            raise resp
+    new = path is not None and path not in migrated
+    if new:
+        open_dataset(path)
+        edited.add(path)
+    db.use(path)
     db.connect(reuse_if_open=True)
+    if new:
+        # like the default dataset at startup
+        scanmethods()
 
 
 def allow_cross_origin(resp):
     resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Access-Control-Expose-Headers'] = 'X-Total-Count, ETag, X-Profile, X-Profile-File'
     resp.headers['Access-Control-Allow-Methods'] = 'PUT, GET, POST, DELETE, OPTIONS'
-    resp.headers['Access-Control-Allow-Headers'] = 'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token'
+    resp.headers['Access-Control-Allow-Headers'] = 'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token, X-Dataset, X-Profile'
 
 
 @hook('after_request')
@@ -365,13 +716,20 @@ def get_statistics():
             'total_analyses_completed': counts['FINISHED'] if 'FINISHED' in counts else 0,
             'total_analyses_failed': counts['FAILED'] if 'FAILED' in counts else 0,
             'total_analyses_processing': counts['PROCESSING'] if 'PROCESSING' in counts else 0,
-            'total_analyses_queued': counts['QUEUED'] if 'QUEUED' in counts else 0
+            'total_analyses_queued': counts['QUEUED'] if 'QUEUED' in counts else 0,
+            'total_analyses_cancelled': counts['CANCELLED'] if 'CANCELLED' in counts else 0
             }
     return fr()(data)
 
 # try this instead for selecting dataset
 # https://docs.faculty.ai/user-guide/apis/flask_apis/flask_file_upload_download.html   
 
+@get('/metrics')
+def get_metrics():
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return metrics.exposition()
+
+
 @get('/datasets')
 def get_datasets():
     print('********** get_datasets() ***************')
@@ -389,14 +747,58 @@ def get_datasets():
     return json.dumps(data)
 
 
+# The dataset is chosen per request (see br()), this only checks the name
+# and returns the prefix for the routes of the dataset.  It used to switch
+# the dataset of every client.
 @post('/dataset')
 def set_dataset():
-    print('######### set_dataset() ############')
-    fname = request.forms.get('selected')
-    db.close()
-    db.init(os.path.join(abs_db_path, fname + '.db'))
-    # TODO: go to video list page, refresh
-    # maybe this is done in client
+    fname = request.forms.get('selected') or ''
+    if not dataset_path(fname):
+        response.status = 404
+        return fr()({'error': 'Unknown dataset {}.'.format(fname)})
+    return fr()({'dataset': fname, 'prefix': '/dataset/{}/'.format(fname)})
+
+
+# Counts of detections over many datasets, for each day (dataset) and in
+# total, by camera and by method.  from and to (YYYY-MM-DD) select days by
+# the date in the names of the databases, prefix selects <prefix>-... files.
+@get('/datasets/statistics')
+def get_datasets_statistics():
+    try:
+        start = datasets.parse_date(request.query['from']) if request.query.get('from') else None
+        end = datasets.parse_date(request.query['to']) if request.query.get('to') else None
+    except ValueError as e:
+        response.status = 400
+        return fr()({'error': 'Unable to parse date.', 'details': str(e)})
+    found = datasets.find_datasets(abs_db_path, start, end, request.query.get('prefix'))
+    days = summaries.get([path for name, path, date in found])
+    return fr()({
+        'from': start.isoformat() if start else None,
+        'to': end.isoformat() if end else None,
+        'total': datasets.combine(days),
+        'datasets': [dict(s, name=name, date=date.isoformat() if date else None)
+                     for (name, path, date), s in zip(found, days)]
+    })
+
+
+# ZIP of the detections of every video of one or more datasets, sent while
+# it is generated (see eyesea_export.py).  datasets is a comma separated list
+# of names as listed by /datasets, the current dataset by default.
+@get('/datasets/export')
+def export_datasets():
+    names = [n for n in (request.query.get('datasets') or '').split(',') if n]
+    if not names:
+        selected = [(dataset_name(), db.database)]
+    else:
+        selected = [(n, dataset_path(n)) for n in names]
+    for name, path in selected:
+        if not path:
+            response.status = 404
+            return fr()({'error': 'Unknown dataset {}.'.format(name)})
+    fname = (selected[0][0] if len(selected) == 1 else 'eyesea-export') + '.zip'
+    response.content_type = 'application/zip'
+    response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
+    return export.zip_stream(export.dataset_entries(selected))
 
 
 # FIXME
@@ -407,13 +809,25 @@ def get_video():
     sortBy = []
     if 'sortBy' in request.query:
         try:
-            sortBy = map(lambda sort: getattr(video, sort['prop']) if sort['asc'] else -getattr(
-                video, sort['prop']), json.loads(request.query['sortBy']))
+            sortBy = list(map(lambda sort: getattr(video, sort['prop']) if sort['asc'] else -getattr(
+                video, sort['prop']), json.loads(request.query['sortBy'])))
         except ValueError as error:
             return {'error': 'Error parsing sortBy parameter', 'details': str(error)}
-
-    data = video.select(video).order_by(*sortBy).dicts()
-    data = [format_video(i) for i in data]
+    # optional paging, the total number of videos is in the X-Total-Count header
+    try:
+        limit = int(request.query.get('limit', 0))
+        offset = int(request.query.get('offset', 0))
+    except ValueError as error:
+        return {'error': 'Error parsing limit or offset parameter', 'details': str(error)}
+    summary = request.query.get('summary', '').lower() in ('1', 'true', 'yes')
+
+    query = video.select(video).order_by(*sortBy)
+    response.headers['X-Total-Count'] = str(query.count())
+    if limit > 0:
+        query = query.limit(limit)
+    if offset > 0:
+        query = query.offset(offset)
+    data = format_videos(list(query.dicts()), summary)
     return fr()(data)
 
 
@@ -481,7 +895,7 @@ def post_video():
         results = []
         for i, a in enumerate(analyses):
             results.append(queue_analysis(
-                i, data['vid'], a['mid'], a['parameters']))
+                i, data['vid'], a['mid'], a['parameters'], a.get('priority', 0)))
 
         return fr()(format_video(data, results))
     return fr()({'error': 'Video metadata returned no streams.'})
@@ -506,20 +920,30 @@ def server_static(vid):
     return resp
 
 
-@route('/video/<vid>/thumbnail')
-def video_thumbnail(vid):
-    v = video.select().where(video.vid == vid).dicts().get()
+# Extract the thumbnail of a video row into the cache if it isn't there,
+# returns the file name in the cache.  Doesn't need a request, so it can run
+# in the background.
+def thumbnail_image(v):
     pathname, filename, root = get_video_path_parts(v)
     image = filename + '.jpg'
-    if not os.path.isfile(cache + os.sep + image):
+    hit = os.path.isfile(cache + os.sep + image)
+    metrics.cache_lookup('thumbnail', hit)
+    if not hit:
         try:
             subprocess.check_output(['ffmpeg', '-y', '-i', '{p}/{f}'.format(p=root, f=pathname),
                 '-ss','00:00:01.000', '-vframes', '1', cache + os.sep + image])
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, OSError) as e:
+            # a blank image if the frame can't be extracted or ffmpeg is missing
             img = Image.new('RGB', (640, 480), (255, 255, 255))
             print('to cache: ' + cache + os.sep + image)
             img.save(cache + os.sep + image, 'jpeg')
+    return image
+
 
+@route('/video/<vid>/thumbnail')
+def video_thumbnail(vid):
+    v = video.select().where(video.vid == vid).dicts().get()
+    image = thumbnail_image(v)
     print('from cache: ' + cache + os.sep + image)
     resp = static_file(image, root=cache)
     allow_cross_origin(resp)
@@ -532,51 +956,26 @@ def video_thumbnail(vid):
 @route('/video/<vid>/heatmap/json')
 def video_heatmap_json(vid):
     v = video.select().where(video.vid == vid).dicts().get()
-    a = analysis.select().where(analysis.vid == vid,
-                                analysis.status == 'FINISHED').dicts()
+    compact_edits(vid)
     pathname, filename, root = get_video_path_parts(v)
-    output = filename + '_heatmap.json'
-    if not os.path.isfile(cache + os.sep + output):
-        w = v['width']
-        h = v['height']
-        y, x = np.mgrid[0:h, 0:w]
-        d = np.zeros((h, w))
-        for i in a:
-            for j in json.loads(i['results']):
-                for q in j['detections']:
-                    k = {key: int(value) for key, value in q.items()}
-                    if 'y1' in k and 'y2' in k and 'x1' in k and 'x2' in k:
-                        if k['y1'] <= k['y2']:
-                            for l in range(k['y1'], k['y2'], 1):
-                                if k['x1'] <= k['x2']:
-                                    d[l][k['x1']:k['x2']] += 1
-                                else:
-                                    d[l][k['x2']:k['x1']] += 1
-                        else:
-                            for l in range(k['y2'], k['y1'], 1):
-                                if k['x1'] <= k['x2']:
-                                    d[l][k['x1']:k['x2']] += 1
-                                else:
-                                    d[l][k['x2']:k['x1']] += 1
+    w = v['width']
+    h = v['height']
+    a = list(heatmap_analyses(vid))
+    output = heatmap_file(filename, heatmap_key(a, w, h), 'json')
+    hit = os.path.isfile(cache + os.sep + output)
+    metrics.cache_lookup('heatmap_json', hit)
+    if not hit:
+        d = heatmap.sum_grids(heatmap_grids(a, w, h), (h, w))
 
         max_det = np.max(d)
         # reduce the matrix to a manageable size
-        s = np.zeros((100, 100))
-        for y in range(len(d)):
-            for x in range(len(d[y])):
-                a = int(math.floor(np.interp(y, [0, h], [0, 100])))
-                b = int(math.floor(np.interp(x, [0, w], [0, 100])))
-                s[a][b] = max(s[a][b], d[y][x])
+        s = heatmap.downsample(d, 100, 100)
         # the visualization needs pairs
-        pairs = []
-        for y in range(len(s)):
-            for x in range(len(s[y])):
-                if s[y][x] > 0:
-                    pairs.append([x, 100 - y, s[y][x]])
-        data = {'id': int(vid), 'maxdet': max_det, 'data': pairs}
+        data = {'id': int(vid), 'maxdet': max_det, 'data': heatmap.pairs(s)}
         with open(cache + os.sep + output, 'w') as fp:
             print('to cache: ' + cache + os.sep + output)
             json.dump(data, fp, sort_keys=True, indent=4)
+        remove_stale(heatmap_pattern(filename, 'json'), output)
 
     print('from cache: ' + cache + os.sep + output)
     resp = static_file(output, root=cache)
@@ -584,118 +983,89 @@ def video_heatmap_json(vid):
     return resp
 
 
-# original heatmap overlayed on thumbnail image
-@route('/video/<vid>/heatmap')
-def video_heatmap(vid):
+# Render the heatmap of a video over its thumbnail in a worker process,
+# returns the file name in the cache.  Like thumbnail_image(), it doesn't
+# need a request.
+def heatmap_image(vid):
     v = video.select().where(video.vid == vid).dicts().get()
-    a = analysis.select().where(analysis.vid == vid,
-                                analysis.status == 'FINISHED').dicts()
+    compact_edits(vid)
     pathname, filename, root = get_video_path_parts(v)
-    image = filename + '.jpg'
-    output = filename + '_heatmap.jpg'
-    if not os.path.isfile(cache + os.sep + output):
-        if not os.path.isfile(cache + os.sep + image):
-            video_thumbnail(vid)
-
-        def transparent_cmap(cmap, N=8):
-            mycmap = cmap
-            mycmap._init()
-            mycmap._lut[:, -1] = np.linspace(0.5, 1, N+3)
-            return mycmap
-
-        I = Image.open(cache + os.sep + image).convert('LA')
+    image = thumbnail_image(v)
+    with Image.open(cache + os.sep + image) as I:
         w, h = I.size
-        y, x = np.mgrid[0:h, 0:w]
-        d = np.zeros((h, w))
-        for i in a:
-            for j in json.loads(i['results']):
-                for q in j['detections']:
-                    k = {key: int(value) for key, value in q.items()}
-                    if 'y1' in k and 'y2' in k and 'x1' in k and 'x2' in k:
-                        if k['y1'] <= k['y2']:
-                            for l in range(k['y1'], k['y2'], 1):
-                                if k['x1'] <= k['x2']:
-                                    d[l][k['x1']:k['x2']] += 1
-                                else:
-                                    d[l][k['x2']:k['x1']] += 1
-                        else:
-                            for l in range(k['y2'], k['y1'], 1):
-                                if k['x1'] <= k['x2']:
-                                    d[l][k['x1']:k['x2']] += 1
-                                else:
-                                    d[l][k['x2']:k['x1']] += 1
-
-        max_det = np.max(d)
-        plt.style.use('dark_background')
-        # cmap = transparent_cmap(mcolors.LinearSegmentedColormap.from_list('', ['#800026', '#ffffcc']))
-        cmap = transparent_cmap(mcolors.LinearSegmentedColormap.from_list(
-            '', ['black', '#429321', '#F0ED5E', '#F40E06'], N=8))
-        fig = plt.figure()
-        ax = fig.subplots(1, 1)
-        ax.imshow(I)
-        ax.axes.get_xaxis().set_visible(False)
-        ax.axes.get_yaxis().set_visible(False)
-        cb = ax.contourf(x, y, d, cmap=cmap)
-        divider = make_axes_locatable(ax)
-        cax = divider.append_axes('right', size='5%', pad=0.05)
-        cbar = plt.colorbar(cb, cax=cax)
-        # cbar.set_ticks([0,0.125*det,0.25*det,0.375*det,0.5*det,0.625*det,0.75*det,0.875*det,det])
-        cbar.set_ticks(
-            (np.array([0, 0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875, 1.00])*max_det).tolist())
-        #cbar.set_ticklabels(['0%', '12.5%', '25%', '37.5%', '50%', '62.5%', '75%', '87.5%', '100%'])
+    a = list(heatmap_analyses(vid))
+    output = heatmap_file(filename, heatmap_key(a, w, h), 'jpg')
+    hit = os.path.isfile(cache + os.sep + output)
+    metrics.cache_lookup('heatmap', hit)
+    if not hit:
         print('to cache: ' + cache + os.sep + output)
-        plt.savefig(cache + os.sep + output, bbox_inches='tight')
+        renderer.render(heatmap_grids(a, w, h), (h, w),
+                        cache + os.sep + image, cache + os.sep + output)
+        remove_stale(heatmap_pattern(filename, 'jpg'), output)
+    return output
+
+
+# render ahead of time so the heatmap is ready when it is first requested
+def prerender_heatmap(vid, dataset):
+    try:
+        with db.using(dataset):
+            output = heatmap_image(vid)
+        if not os.path.isfile(cache + os.sep + output):
+            print('Heatmap of video {} was not rendered: {}'.format(vid, output))
+    except Exception as e:
+        print(exception_to_string(e))
 
+
+# original heatmap overlayed on thumbnail image
+@route('/video/<vid>/heatmap')
+def video_heatmap(vid):
+    output = heatmap_image(vid)
     print('from cache: ' + cache + os.sep + output)
     resp = static_file(output, root=cache)
     allow_cross_origin(resp)
     return resp
 
 
+# stats is a video_stats row, see update_statistics()
+def format_statistics(stats):
+    def percent(frames_with_detections, frames, analyses):
+        return (frames_with_detections / frames) / analyses if frames and analyses else 0
+
+    return {
+        'id': stats['vid'],
+        'totalDetections': stats['total_detections'],
+        'percentTimeWithDetections': percent(stats['frames_with_detections'], stats['frames'],
+                                             stats['analyses']),
+        'minBoundingBoxLength': stats['min_length'],
+        'avgBoundingBoxLength': stats['sum_length'] / stats['total_detections']
+        if stats['total_detections'] else 0,
+        'maxBoundingBoxLength': stats['max_length'],
+        'frameIndexWithHighestDetections': stats['peak_frame'],
+        'methods': [{
+            'id': m['id'],
+            'method': m['method'],
+            'totalDetections': m['detections'],
+            'percentTimeWithDetections': percent(m['framesWithDetections'], m['frames'], 1),
+            'minBoundingBoxLength': m['minLength'],
+            'avgBoundingBoxLength': m['sumLength'] / m['detections'] if m['detections'] else 0,
+            'maxBoundingBoxLength': m['maxLength'],
+            'frameIndexWithHighestDetections': m['peakFrame']
+        } for m in json.loads(stats['methods'])]
+    }
+
+
+# Statistics are kept in the video_statistics table, they are only computed
+# here for videos that don't have a row yet (from an older database).
 @route('/video/<vid>/statistics')
 def video_statistics(vid):
-    v = video.select().where(video.vid == vid).dicts().get()
-    a = analysis.select().where(analysis.vid == vid,
-                                analysis.status == 'FINISHED').dicts()
-    analyses = dict()
-    total_detections = 0
-    frames_with_detections = 0.0
-    frame_count = 0
-    max_detections = (0, 0)
-    min_length = inf
-    avg_length = 0
-    max_length = -inf
-
-    for i in a:
-        results = json.loads(i['results'])
-        # print(results)
-        analyses[i['aid']] = results
-        if results:
-            frame_count = max(frame_count, results[-1]['frameindex'])
-        print("frame_count = {:d}".format(frame_count))
-
-        for j in range(0, frame_count):
-            count = len(results[j]['detections'])
-            if count:
-                frames_with_detections += 1
-            total_detections += count
-            if count > max_detections[1]:
-                max_detections = (j, count)
-            for k in results[j]['detections']:
-                length = max(abs(k['x2'] - k['x1']), abs(k['y2'] - k['y1']))
-                min_length = min(min_length, length)
-                avg_length += length
-                max_length = max(length, max_length)
-
-    return fr()({
-        'id': int(vid),
-        'totalDetections': total_detections,
-        'percentTimeWithDetections': (frames_with_detections / frame_count) / len(a) if frame_count else 0,
-        'minBoundingBoxLength': min_length if not np.isposinf(min_length) else 0,
-        'avgBoundingBoxLength': avg_length / total_detections if total_detections else 0,
-        'maxBoundingBoxLength': max_length if max_length >= 0 else 0,
-        'frameIndexWithHighestDetections': max_detections[0]
-    })
+    compact_edits(vid)
+    try:
+        stats = video_stats.select().where(video_stats.vid == vid).dicts().get()
+    except video_stats.DoesNotExist:
+        video.select(video.vid).where(video.vid == vid).get()
+        update_statistics(int(vid))
+        stats = video_stats.select().where(video_stats.vid == vid).dicts().get()
+    return fr()(format_statistics(stats))
 
 
 @put('/video/<vid>')
@@ -718,11 +1088,155 @@ def post_analysis():
     return fr()(data)
 
 
+# the queue is shared by all datasets
+def queue_view():
+    return [dict(q, dataset=dataset_name(q['dataset'])) for q in jobs.queue()]
+
+
+@get('/analysis/queue')
+def get_analysis_queue():
+    running = [{'dataset': dataset_name(dataset), 'id': aid, 'method': task['mid'], 'started': task['started'],
+                'shards': len(task['outputs'])}
+               for (dataset, aid), task in tasklist.items()]
+    return fr()({'maxWorkers': jobs.max_workers, 'running': running, 'queued': queue_view()})
+
+
+@post('/analysis/<aid>/cancel')
+def cancel_analysis(aid):
+    if not aid.isdigit():
+        return fr()({'error': 'Not a valid analysis ID'})
+    task = tasklist.get((db.database, int(aid)))
+    if not jobs.cancel((db.database, int(aid))):
+        return fr()({'error': 'Analysis is not queued or processing', 'details': aid})
+    if task:
+        metrics.jobs.inc(method=task['mid'], status='CANCELLED')
+        metrics.job_seconds.observe(time.time() - task['started'], method=task['mid'], status='CANCELLED')
+    data = analysis.select().where(analysis.aid == aid).dicts().get()
+    return fr()(data)
+
+
+@put('/analysis/<aid>/priority')
+def put_analysis_priority(aid):
+    if not aid.isdigit():
+        return fr()({'error': 'Not a valid analysis ID'})
+    try:
+        priority = int(request.json['priority'])
+    except (TypeError, KeyError, ValueError) as error:
+        return fr()({'error': 'Error parsing priority', 'details': str(error)})
+    if not jobs.reprioritize((db.database, int(aid)), priority):
+        return fr()({'error': 'Analysis is not queued', 'details': aid})
+    return fr()({'id': int(aid), 'priority': priority, 'queue': queue_view()})
+
+
+# Detections of frames start to end - 1 for playback, as flat arrays: frame
+# index of every detection, its x1, y1, x2, y2 in boxes (4 per detection)
+# and its id in dids.
+# Responses carry an ETag of the results version; a client that passes the
+# version it got back as v= may cache the window indefinitely.
+@get('/analysis/<aid>/frames')
+def get_analysis_frames(aid):
+    if not aid.isdigit():
+        return fr()({'error': 'Not a valid analysis ID'})
+    try:
+        a = analysis.select(analysis.aid, analysis.status, analysis.nframes, analysis.version).where(
+            analysis.aid == aid).dicts().get()
+    except analysis.DoesNotExist:
+        return fr()({'error': 'Analysis does not exist', 'details': aid})
+    try:
+        start = max(int(request.query.get('start', 0)), 0)
+        end = int(request.query.get('end', a['nframes'] or 0))
+    except ValueError as error:
+        return fr()({'error': 'Error parsing start or end parameter', 'details': str(error)})
+
+    etag = '"{}-{}-{}-{}-{}"'.format(dataset_name(), a['aid'], a['version'], start, end)
+    if request.query.get('v') == str(a['version']):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    response.headers['ETag'] = etag
+    if request.get_header('If-None-Match') == etag:
+        response.status = 304
+        return ''
+
+    frames = []
+    boxes = []
+    dids = []
+    if a['status'] == 'FINISHED':
+        frames, boxes, dids = window_columns(load_columns(a['aid']), start, end)
+        frames = frames.tolist()
+        boxes = boxes.ravel().tolist()
+        dids = dids.tolist()
+    return fr()({
+        'id': a['aid'],
+        'status': a['status'],
+        'version': a['version'],
+        'start': start,
+        'end': end,
+        'frames': frames,
+        'boxes': boxes,
+        'dids': dids
+    })
+
+
+# x1, y1, x2, y2 and frameIndex (None if missing) of a detection in the body
+def detection_body():
+    data = request.json
+    box = {k: float(data[k]) for k in ('x1', 'y1', 'x2', 'y2')}
+    frameindex = data.get('frameIndex')
+    return box, None if frameindex is None else int(frameindex)
+
+
+def edit_response(aid, result):
+    if result is None:
+        return fr()({'error': 'Analysis or detection does not exist', 'details': aid})
+    edited.add(db.database)
+    did, version = result
+    return fr()({'id': did, 'analysis': int(aid), 'version': version})
+
+
+# Edits of single detections of a finished analysis, e.g. while dragging
+# boxes in the client.  They are written to the detection table at once,
+# the statistics and heatmaps catch up in the background or when they are
+# next requested (see compact_edits).  Responses have the id of the
+# detection and the new results version.
+@post('/analysis/<aid>/detections')
+def post_detection(aid):
+    if not aid.isdigit():
+        return fr()({'error': 'Not a valid analysis ID'})
+    try:
+        box, frameindex = detection_body()
+        if frameindex is None or frameindex < 0:
+            raise ValueError('frameIndex is required')
+    except (TypeError, KeyError, ValueError, AttributeError) as error:
+        return fr()({'error': 'Error parsing detection', 'details': str(error)})
+    return edit_response(aid, edit_detection(int(aid), 'add', frameindex=frameindex, box=box))
+
+
+@put('/analysis/<aid>/detections/<did>')
+def put_detection(aid, did):
+    if not aid.isdigit() or not did.isdigit():
+        return fr()({'error': 'Not a valid analysis or detection ID'})
+    try:
+        box, frameindex = detection_body()
+        if frameindex is not None and frameindex < 0:
+            raise ValueError('frameIndex is negative')
+    except (TypeError, KeyError, ValueError, AttributeError) as error:
+        return fr()({'error': 'Error parsing detection', 'details': str(error)})
+    return edit_response(aid, edit_detection(int(aid), 'move', int(did), frameindex, box))
+
+
+@delete('/analysis/<aid>/detections/<did>')
+def delete_detection(aid, did):
+    if not aid.isdigit() or not did.isdigit():
+        return fr()({'error': 'Not a valid analysis or detection ID'})
+    return edit_response(aid, edit_detection(int(aid), 'delete', int(did)))
+
+
 @get('/analysis/<aid>')
 def get_analysis_aid(aid):
     if aid.isdigit():
         data = analysis.select().where(analysis.aid == aid).dicts().get()
-        data = get_or_update_analysis(data)
+        data = format_analysis(data)
     else:
         data = {'error': 'Not a valid analysis ID'}
     return fr()(data)
@@ -732,6 +1246,7 @@ def get_analysis_aid(aid):
 def put_analysis_aid(aid):
     updata = analysis.update(request.json).where(analysis.aid == aid).execute()
     data = analysis.select().where(analysis.aid == aid).dicts().get()
+    update_statistics(data['vid'])
     return fr()(data)
 
 
@@ -788,69 +1303,30 @@ def process_video():
 
     results = []
     for i, a in enumerate(analyses):
-        results.append(queue_analysis(i, vid, a['mid'], a))
+        results.append(queue_analysis(i, vid, a['mid'], a, a.get('priority', 0)))
     # print(results)
     return fr()(format_video(data, results))
 
+# The CSV is generated while it is being sent, nothing is written to disk.
+# Compressed with gzip if the client accepts it.
 @get('/video/<vid>/<filename>')
 def write_csv(vid, filename):
-    import csv
-    import datetime
-
     v = video.select(video).where(video.vid == vid).dicts().get()
     fname = os.path.splitext(os.path.basename(v['filename']))[0] + '.csv'
 
-    a = analysis.select().where(analysis.vid == vid,
-                                analysis.status == 'FINISHED').dicts()
-
-    colnames = ['time', 'x', 'y', 'w', 'h', 'method']
-    with open(os.path.join(tmp, fname),'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(colnames)
-        
-        for i in a:
-            m = analysis_method.select().where(analysis_method.mid == i['mid']).dicts().get()
-            ms = m['description']
-            for j in json.loads(i['results']):
-                if len(j['detections']) == 0: continue
-                ts = str(datetime.timedelta(seconds=j['frameindex']/v['fps']))
-                for q in j['detections']:
-                    x = int(min(q['x1'], q['x2']))
-                    y = int(min(q['y1'], q['y2']))
-                    w = int(abs(q['x1'] - q['x2']))
-                    h = int(abs(q['y1'] - q['y2']))
-                    row = [ts, x, y, w, h, ms]
-                    writer.writerow(row)
-
-    return static_file(fname, root=tmp)
-
-def zipdir(path, ziph):
-    # ziph is zipfile handle
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            ziph.write(os.path.join(root, file))
-
-
-#@get('/video/<vid>/<filename>')
-def compress_annotations(vid, filename):
-    a = analysis.select().where(analysis.vid == vid,
-                                analysis.status == 'FINISHED').dicts()
-    os.mkdir(tmp + os.path.sep + vid)
-    # collect all the annotations
-    for i in a:
-        with open(tmp + os.path.sep + vid + os.path.sep + str(i['aid']) + ".json", "w") as f:
-            f.write(i["results"])
-    fname = vid + '.zip'
-    zipf = zipfile.ZipFile(tmp + os.path.sep + fname, 'w', zipfile.ZIP_DEFLATED)
-    for root, dirs, files in os.walk(tmp + os.path.sep + vid):
-        for file in files:
-            zipf.write(os.path.join(root, file))
-    zipf.close()
-    print(tmp + os.path.sep + vid + '.zip')
-    for i in os.listdir(tmp + os.path.sep + vid):
-        os.remove(os.path.join(tmp + os.path.sep + vid, i))
-    os.rmdir(tmp + os.path.sep + vid)
-    return static_file(fname, root=tmp)
+    # method names are resolved once, with the analyses
+    a = list(analysis.select(analysis.aid, analysis_method.description).join(
+        analysis_method, on=(analysis.mid == analysis_method.mid)).where(
+        analysis.vid == vid, analysis.status == 'FINISHED').order_by(analysis.aid).tuples())
+
+    rows = export.csv_rows(db, v['fps'], a)
+    response.content_type = 'text/csv; charset=UTF-8'
+    response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
+    if 'gzip' in (request.get_header('Accept-Encoding') or ''):
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return export.gzip_stream(rows)
+    return rows
 
 
 @post('/annotations')
@@ -860,16 +1336,26 @@ def annotations():
     aid = 0
     if len(data) > 0:
         i = json.loads(data)
-        for j in i['analyses']:
-            try:
-                a = analysis.select().where(analysis.vid ==
-                                            i['id'], analysis.status == 'FINISHED', analysis.mid == j['method']).dicts().get()
-                aid = a['aid']
-                analysis.update(results=json.dumps(j['results'])).where(
-                    analysis.aid == aid).execute()
-            except analysis.DoesNotExist:
-                aid = analysis.insert({'mid': j['method'], 'vid': i['id'], 'status': 'FINISHED',
-                                       'parameters': '', 'results': json.dumps(j['results'])}).execute()
+        # all analyses are saved in one transaction, the heatmap grids are
+        # only updated once it is committed
+        changed = []
+        compact_edits(i['id'])
+        with db.atomic():
+            for j in i['analyses']:
+                try:
+                    a = analysis.select().where(analysis.vid ==
+                                                i['id'], analysis.status == 'FINISHED', analysis.mid == j['method']).dicts().get()
+                    aid = a['aid']
+                    changed.append((aid, a['version'], analysis_boxes(aid)))
+                    store_results(aid, j['results'])
+                except analysis.DoesNotExist:
+                    aid = analysis.insert({'mid': j['method'], 'vid': i['id'], 'status': 'FINISHED',
+                                           'parameters': '', 'results': ''}).execute()
+                    store_results(aid, j['results'])
+            update_statistics(i['id'])
+        for aid, version, old_boxes in changed:
+            update_heatmap_grids(aid, version, *heatmap.box_delta(old_boxes, analysis_boxes(aid)))
+        gevent.spawn(prerender_heatmap, i['id'], db.database)
         return fr()({'status': 'SUCCESS', 'aid': aid})
     return fr()({'status': 'FAILED'})
 
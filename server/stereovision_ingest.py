@@ -111,6 +111,7 @@ def init_database(dbpath, algdir, algname):
     if not os.path.exists(dbpath): 
         print('Creating new database ' + os.path.basename(dbpath))
         create_tables()
+    migrate_database()
     try:
         method = analysis_method.select().where(
             analysis_method.description.contains(algname)
@@ -274,20 +275,8 @@ if __name__ == "__main__":
         # ingest data into EyeSea database
         for vf,fr,dur,p,res,imgpath in zip(video_files,video_fps,video_dur,analysis_proc,analysis_results, image_paths):
             print("Ingesting {} into EyeSea database".format(os.path.basename(vf)))
-            data = video.select().where(
-                video.vid==video.insert(
-                    filename = vf
-                    , duration = dur
-                    , description = os.path.splitext(os.path.basename(vf))[0]
-                    , fps = fr
-                    , creation_date = int(time.time())
-                    , width = 0
-                    , height = 0
-                    , variable_framerate = False
-                    , uri = 'file://' + vf
-                    ).execute()).dicts().get()
-            vid = data['vid']
-            results = ''
+            output = []
+            nframes = None
             status = 'FAILED'
 
             csv_filename = os.path.splitext(os.path.basename(vf))[0] + '.csv'
@@ -304,18 +293,19 @@ if __name__ == "__main__":
                 print('    got results')
                 status = 'FINISHED'
                 with open(res) as f:
-                    output = json.loads(f.read())['frames']
-                    results = json.dumps(output, separators=(',', ':'))
+                    results = json.loads(f.read())
+                # the API writes only the frames with detections, nframes
+                # is the number of frames processed
+                output = results['frames']
+                nframes = results.get('nframes')
                 
-                sorted_output = sorted(output, key=lambda x: x["frameindex"])
+                # frames with detections, every frame goes in the overlay movie
+                by_frame = {out_row["frameindex"]: out_row['detections'] for out_row in output}
                 filenames = sorted(glob.glob(os.path.join(imgpath,'*.jpg')))
 
-                for out_row in sorted_output:
-                    frame_num  = out_row["frameindex"]
-                    detections = out_row['detections']
-
-                    image = cv2.imread(filenames[frame_num])
-                    for det in detections:
+                for frame_num, filename in enumerate(filenames):
+                    image = cv2.imread(filename)
+                    for det in by_frame.get(frame_num, []):
                         x1, y1, x2, y2 = det["x1"], det["y1"], det["x2"], det["y2"]
 
                         cv2.rectangle(image, (x1, y1), (x2, y2), (0, 0, 255), 1)
@@ -323,7 +313,7 @@ if __name__ == "__main__":
                         timestamp = time.strftime('%H:%M:%S', time.gmtime(frame_num/fr))
                         timestamp += "{:.6f}".format(frame_num/fr % 1)[1:]
                         csv_writer.writerow([timestamp, x1, y1, x2 - x1, y2 - y1, algname])
-                    cv2.imwrite(os.path.join(tmp, os.path.basename(vf), os.path.basename(filenames[frame_num])), image)
+                    cv2.imwrite(os.path.join(tmp, os.path.basename(vf), os.path.basename(filename)), image)
 
             detections_file.close()
             
@@ -334,14 +324,32 @@ if __name__ == "__main__":
             )
             shutil.rmtree(os.path.join(tmp, os.path.basename(vf)))
 
-            data = analysis.select().where(
-                analysis.aid==analysis.insert(
-                    mid = mid
-                    , vid = vid
-                    , status = status
-                    , parameters = ''
-                    , results = results
-                    ).execute()).dicts().get()
+            # the rows of a video are written in one transaction
+            with db.atomic():
+                data = video.select().where(
+                    video.vid==video.insert(
+                        filename = vf
+                        , duration = dur
+                        , description = os.path.splitext(os.path.basename(vf))[0]
+                        , fps = fr
+                        , creation_date = int(time.time())
+                        , width = 0
+                        , height = 0
+                        , variable_framerate = False
+                        , uri = 'file://' + vf
+                        ).execute()).dicts().get()
+                vid = data['vid']
+                data = analysis.select().where(
+                    analysis.aid==analysis.insert(
+                        mid = mid
+                        , vid = vid
+                        , status = status
+                        , parameters = ''
+                        , results = ''
+                        ).execute()).dicts().get()
+                if status == 'FINISHED':
+                    store_results(data['aid'], output, nframes)
+                update_statistics(vid)
         db.close()
         nvideos += len(video_files)
 